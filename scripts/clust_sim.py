@@ -1,22 +1,96 @@
+"""
+Clustering similarities from the contingency table of two label vectors:
+        -- overlap1, overlap2: the summed largest overlap of each cluster of the first clustering with
+           a cluster of the second, divided by the number of towers in the first or second clustering
+        -- ari: the adjusted Rand index
+        -- nmi: the mutual information normalized by the mean of the two entropies
+A tower in only one of the clusterings counts in that clustering's denominator but never overlaps.
+"""
 import csv, os
 import numpy as np
+from collections import namedtuple
 from itertools import combinations
 
+from label_clustering import read_clustering_dir
+
+ClusteringSimilarity = namedtuple('ClusteringSimilarity', 'overlap1 overlap2 ari nmi')
+
 
 
 def import_clusts(idir):
-    clusts = dict()
-    for ifile in os.listdir(idir):
-        day = int(ifile.replace('.csv', ''))
-        reader = csv.reader(open(idir + ifile), delimiter=',')
-        clusts[day] = [[int(i) for i in cl] for cl in reader]
-    return clusts
+    return read_clustering_dir(idir)
+
+def contingency_table(clust1, clust2):
+    """
+    :param clust1, clust2: LabelClustering objects
+    :return: the (n_clusters1, n_clusters2) contingency table over the towers in both clusterings
+    """
+    towers = np.intersect1d(clust1.towers, clust2.towers)
+    labels1 = clust1.labels[np.searchsorted(clust1.towers, towers)]
+    labels2 = clust2.labels[np.searchsorted(clust2.towers, towers)]
+    n1, n2 = clust1.n_clusters, clust2.n_clusters
+    return np.bincount(labels1*n2 + labels2, minlength=n1*n2).reshape(n1, n2)
+
+def _pairs(counts):
+    return (counts*(counts - 1)/2.0).sum()
+
+def adjusted_rand_index(table):
+    n = table.sum()
+    index = _pairs(table)
+    rows, cols = _pairs(table.sum(axis=1)), _pairs(table.sum(axis=0))
+    expected = rows*cols/(n*(n - 1)/2.0) if n > 1 else 0.0
+    max_index = (rows + cols)/2.0
+    if max_index == expected:
+        return 1.0
+    return (index - expected)/(max_index - expected)
+
+def _entropy(counts, n):
+    p = counts[counts > 0]/n
+    return -(p*np.log(p)).sum()
+
+def normalized_mutual_info(table):
+    n = float(table.sum())
+    rows, cols = table.sum(axis=1), table.sum(axis=0)
+    h1, h2 = _entropy(rows, n), _entropy(cols, n)
+    if h1 == 0 and h2 == 0:
+        return 1.0
+    i, j = np.nonzero(table)
+    nij = table[i, j]
+    mutual_info = (nij/n*np.log(nij*n/(rows[i]*cols[j].astype(float)))).sum()
+    return mutual_info/((h1 + h2)/2.0)
+
+def clustering_similarity(clust1, clust2):
+    """
+    :return: a ClusteringSimilarity, see the module notes
+    """
+    table = contingency_table(clust1, clust2)
+    numerator = table.max(axis=1).sum() if table.size else 0
+    return ClusteringSimilarity(overlap1=numerator/len(clust1.towers), overlap2=numerator/len(clust2.towers),
+                                ari=adjusted_rand_index(table), nmi=normalized_mutual_info(table))
 
 def clustering_sim(clust1, clust2):
-    numerator = sum(max((len(set(l1).intersection(set(l2))) for l2 in clust2)) for l1 in clust1)
-    denom1 = sum(len(cl1) for cl1 in clust1)
-    denom2 = sum(len(cl2) for cl2 in clust2)
-    return numerator/denom1, numerator/denom2
+    sim = clustering_similarity(clust1, clust2)
+    return sim.overlap1, sim.overlap2
+
+def compare_dirs(cdirs, days=range(2, 31)):
+    """
+    Compares every pair of clustering directories on every day
+    :param cdirs: a name -> clustering directory dictionary
+    :return: a (name1, name2) -> list of (day, ClusteringSimilarity) dictionary
+    """
+    clusts = dict((name, import_clusts(cdir)) for name, cdir in cdirs.items())
+    results = dict()
+    for name1, name2 in combinations(sorted(cdirs.keys()), 2):
+        results[(name1, name2)] = [(day, clustering_similarity(clusts[name1][day], clusts[name2][day]))
+                                   for day in days]
+    return results
+
+def write_comparisons(ofile, results):
+    writer = csv.writer(open(ofile, 'w'), delimiter=',')
+    writer.writerow(['clustering1', 'clustering2', 'day'] + list(ClusteringSimilarity._fields))
+    for (name1, name2), sims in sorted(results.items()):
+        for day, sim in sims:
+            writer.writerow([name1, name2, day] + list(sim))
 
 
 def gen_simmat(clusts1, clusts2):
@@ -48,3 +122,7 @@ if __name__ == "__main__":
 
     gen_simmat(lea_clusts, con_clusts)
 
+    cdirs = {'consensus': con_dir, 'learned': lea_dir, 'naive': nai_dir, 'jaccard': jacc_dir,
+             'connectivity': conn_dir, 'nationality': nat_dir, 'phone_cost': pho_dir}
+    write_comparisons('./clusterings/similarities.csv', compare_dirs(cdirs))
+
@@ -3,6 +3,8 @@ from operator import itemgetter
 from collections import defaultdict
 from math import sqrt
 
+from label_clustering import read_clustering_dir
+
 def ordered_uniqify(lst):
     seen = set()
     olst = list()
@@ -14,13 +16,7 @@ def ordered_uniqify(lst):
 
 
 def import_clustering_dir(cdir):
-    clusters = dict()
-    for ifile in os.listdir(cdir):
-        day = int(ifile.replace('.csv', ''))
-        reader = csv.reader(open(cdir + ifile), delimiter=',')
-        day_clustering = [[int(i) for i in row] for row in reader]
-        clusters[day] = day_clustering
-    return clusters
+    return read_clustering_dir(cdir)
 
 def import_userpaths():
     fpath = './processed_data/user_paths.csv'
@@ -41,15 +37,10 @@ def import_userpaths():
 def compute_pathprecision(path, clusterings):
     info, rest_path = path[0], set(path[1:])
 
-    cl = None
-    for clust in clusterings:
-        if info in clust:
-            cl = set(clust)
-            cl.remove(info)
-            break
-
+    cl = clusterings.cluster_members(info)
     if cl is None:
         return 0, 0
+    cl.remove(info)
 
     return len(rest_path.intersection(cl))/len(rest_path), 1
 
@@ -58,17 +49,12 @@ def compute_pathprecision_multclusts(path, clust1, clust2):
     info, rest_path = path[0], set(path[1:])
 
     cl = set()
-    for clust in clust1:
-        if info in clust:
-            cl = cl.union(set(clust))
-            break
+    for clustering in (clust1, clust2):
+        members = clustering.cluster_members(info)
+        if members is not None:
+            cl = cl.union(members)
 
-    for clust in clust2:
-        if info in clust:
-            cl = cl.union(set(clust))
-            break
-
-    cl.remove(info)
+    cl.discard(info)
 
     if len(cl) is 0:
         return 0, 0
@@ -1,6 +1,6 @@
-import csv, os
+import csv, os, sys, time
+import multiprocessing as mp
 from collections import defaultdict
-from itertools import combinations
 from math import factorial as f
 from random import random
 
@@ -10,175 +10,399 @@ import scipy.spatial.distance as ssd
 from scipy.optimize import minimize
 
 from get_regional_dists import _get_connectivity, _get_jaccard, _get_nationality, _get_phonecost_matrix
-from distance_metrics import get_naive_distance, get_learned_metric, get_input_matrices
+from distance_metrics import get_naive_distance, get_learned_metric, get_input_matrices, to_stack, blend_stack
+from label_clustering import LabelClustering, read_clustering_dir
+from shared_arrays import share_array, attach_array, release
 
+METRICS = ('connectivity', 'phone_cost', 'jaccard', 'nationality')
 
-def AgglomerativeCluster(positions, scores, max_dist):
-    distarray = ssd.squareform(scores)
-
-    Z = linkage(distarray, 'average')
-    pos_map = dict()
-    for pos, value in enumerate(positions):
-        pos_map[pos] = value
 
-    clusts = fcluster(Z, max_dist, criterion='distance')
+def _group_labels(positions, clusts):
     clustered = defaultdict(set)
     for pos, clust in enumerate(clusts):
-        val = pos_map[pos]
-        clustered[clust].add(pos_map[pos])
+        clustered[clust].add(positions[pos])
 
     return [list(s) for s in clustered.values()]
 
 
-def score_clustering(clustering, towers, scores):
-    clust_subscore = 0.0
-    for clust in clustering:
-        if len(clust) == 1:
-            clust_subscore += 100
-            continue
+def AgglomerativeCluster(positions, scores, max_dist):
+    distarray = ssd.squareform(scores)
+
+    Z = linkage(distarray, 'average')
+    clusts = fcluster(Z, max_dist, criterion='distance')
+    return _group_labels(list(positions), clusts)
+
+
+def _clustering_score(n_towers, n_clusters, singletons, pairs):
+    """
+    The score of score_clustering from cluster counts: every singleton costs 100, every other
+    cluster its number of tower pairs, averaged over clusters, minus the mean cluster size
+    """
+    return (100*singletons + pairs)/n_clusters - n_towers/n_clusters
+
+
+class LinkageTree:
+    """
+    The average-linkage tree of one distance matrix, built once and cut at any threshold.
+    The flat clustering only changes at merge heights, so sweep() scores every distinct
+    clustering in one pass over the merges and best_cut() is an exact threshold search.
+    """
+
+    def __init__(self, positions, scores):
+        self.positions = list(positions)
+        self.Z = linkage(ssd.squareform(scores), 'average')
+
+    def labels(self, max_dist):
+        return fcluster(self.Z, max_dist, criterion='distance')
+
+    def cut(self, max_dist):
+        return _group_labels(self.positions, self.labels(max_dist))
+
+    def score(self, max_dist):
+        return score_labels(self.labels(max_dist))
+
+    def sweep(self):
+        """
+        :return: an array of thresholds, one per distinct flat clustering, and the score_clustering
+            score of the clustering each threshold produces
+        """
+        n = len(self.positions)
+        if n < 2:
+            return np.zeros(1), np.array([_clustering_score(n, max(n, 1), n, 0)])
+
+        sizes = np.ones(2*n - 1, dtype=int)
+        n_clusters, singletons, pairs = n, n, 0
+        thresholds = [np.nextafter(self.Z[0, 2], -np.inf)]
+        scores = [_clustering_score(n, n_clusters, singletons, pairs)]
+
+        for i, (a, b, height, _) in enumerate(self.Z):
+            sa, sb = sizes[int(a)], sizes[int(b)]
+            sizes[n + i] = sa + sb
+            n_clusters -= 1
+            singletons -= int(sa == 1) + int(sb == 1)
+            pairs += sa*sb
+            if i + 1 == len(self.Z) or self.Z[i + 1, 2] != height:
+                thresholds.append(height)
+                scores.append(_clustering_score(n, n_clusters, singletons, pairs))
+
+        return np.array(thresholds), np.array(scores)
+
+    def best_cut(self):
+        """
+        :return: the threshold with the lowest score and that score
+        """
+        thresholds, scores = self.sweep()
+        idx = int(np.argmin(scores))
+        return thresholds[idx], scores[idx]
+
+
+def score_labels(labels):
+    """
+    The score_clustering score of a flat clustering given as integer labels
+    """
+    sizes = np.bincount(np.asarray(labels))
+    sizes = sizes[sizes > 0]
+    return _clustering_score(sizes.sum(), len(sizes), np.count_nonzero(sizes == 1),
+                             int((sizes*(sizes - 1)//2).sum()))
 
-        curr_score, curr_ct = 0.0, 0
-        for t1, t2 in combinations(clust, 2):
-            idx1, idx2 = list(towers).index(t1), list(towers).index(t2)
-            curr_score += scores[idx1, idx2]
-            curr_ct += 1
-        clust_subscore += curr_ct
 
-    size_subscore = sum(len(c) for c in clustering)/len(clustering)
-    return clust_subscore/len(clustering) - size_subscore
+def score_clustering(clustering, towers, scores):
+    sizes = [len(clust) for clust in clustering]
+    return score_labels(np.repeat(np.arange(len(sizes)), sizes))
 
 
 def compute_naive_clustering(max_dist, dists, pos):
-    clustering = AgglomerativeCluster(pos, dists, max_dist)
-    score = score_clustering(clustering, pos, dists)
-    # score += sum(1 for cl in clustering if len(cl) == 1)
-    # score += sum(len(cl) for cl in clustering)/len(clustering)
-    return score
+    Z = linkage(ssd.squareform(dists), 'average')
+    return score_labels(fcluster(Z, max_dist, criterion='distance'))
 
 
 def compute_learned_clustering(in_arr, pos, conn_mat, ph_mat, jacc_mat, nat_mat):
     max_dist, conn_p, nat_p, jacc_p, ph_p = in_arr
     learned_mat = (1/(conn_p + nat_p+jacc_p+ph_p))*(conn_p*conn_mat + nat_p*nat_mat+jacc_p*jacc_mat+ph_p*ph_mat)
-    clustering = AgglomerativeCluster(pos, learned_mat, max_dist)
-    score = score_clustering(clustering, pos, learned_mat)
-    return score
+    return compute_naive_clustering(max_dist, learned_mat, pos)
+
+
+def cluster_day(dist_mat, pos):
+    tree = LinkageTree(pos, dist_mat)
+    max_dist, _ = tree.best_cut()
+    return tree.cut(max_dist)
+
+
+class LearnedOptimizer:
+    """
+    Optimizes the learned metric (max_dist and the four feature weights) day by day.
+    With warm_start, a day starts from the previous day's solution when that scores at least as
+    well as x0 on the day, both scored as one batch with blend_stack. Objective values are cached
+    by the parameter vector rounded to `decimals`. The per-day evaluations and wall time are kept
+    in `stats`.
+    """
+
+    def __init__(self, pos, x0=(.5, .5, .5, .5, .5), warm_start=False, decimals=4):
+        self.pos = list(pos)
+        self.x0 = np.array(x0, dtype=float)
+        self.warm_start = warm_start
+        self.decimals = decimals
+        self.prev_x = None
+        self.stats = list()
+
+    def _key(self, x):
+        return tuple(np.round(x, self.decimals).tolist())
+
+    @staticmethod
+    def _weights(xs):
+        # in_arr order is max_dist, conn, nat, jacc, phone; feature stacks are conn, phone, jacc, nat
+        xs = np.atleast_2d(xs)
+        return xs[:, [1, 4, 3, 2]]
+
+    def evaluate_batch(self, xs, stack, cache):
+        """
+        Scores many parameter vectors, blending all of their matrices in one call
+        :param xs: a (K, 5) array of parameter vectors
+        :param stack: the (4, T, T) conn, phone, jacc, nat stack of the day
+        """
+        keys = [self._key(x) for x in xs]
+        todo = [(k, x) for k, x in zip(keys, xs) if k not in cache]
+        if todo:
+            blended = blend_stack(stack, self._weights([x for _, x in todo]))
+            for (k, x), mat in zip(todo, blended):
+                cache[k] = compute_naive_clustering(x[0], mat, self.pos)
+        return np.array([cache[k] for k in keys])
+
+    def _start(self, stack, cache):
+        if not self.warm_start or self.prev_x is None:
+            return self.x0
+        # a previous solution can sit in a poor basin for the new day, keep x0 when it scores better
+        prev_score, x0_score = self.evaluate_batch(np.array([self.prev_x, self.x0]), stack, cache)
+        return self.prev_x if prev_score <= x0_score else self.x0
+
+    def optimize_day(self, day, c_mat, p_mat, j_mat, n_mat):
+        """
+        :return: the optimal parameter vector and its clustering
+        """
+        istart = time.time()
+        stack = np.array([c_mat, p_mat, j_mat, n_mat])
+        cache, calls = dict(), [0, 0]
+
+        def objective(x):
+            calls[0] += 1
+            key = self._key(x)
+            score = cache.get(key, None)
+            if score is None:
+                score = compute_naive_clustering(x[0], blend_stack(stack, self._weights(x)[0]), self.pos)
+                cache[key] = score
+            else:
+                calls[1] += 1
+            return score
+
+        res = minimize(objective, self._start(stack, cache), method='nelder-mead')
+
+        if self.warm_start:
+            self.prev_x = np.array(res.x)
+        max_dist, conn_p, nat_p, jacc_p, ph_p = res.x
+        learned_mat = (1 / (conn_p + nat_p + jacc_p + ph_p)) * (conn_p * c_mat + nat_p * n_mat + jacc_p * j_mat+ ph_p * p_mat)
+        clustering = AgglomerativeCluster(self.pos, learned_mat, max_dist)
+
+        self.stats.append((day, res.nfev, len(cache), calls[1], time.time() - istart, res.fun))
+        return res.x, clustering
+
+
+def learned_cluster_day(pos, c_mat, p_mat, j_mat, n_mat):
+    _, clustering = LearnedOptimizer(pos).optimize_day(None, c_mat, p_mat, j_mat, n_mat)
+    return clustering
+
+
+def write_clusterings(odir, clusterings, binary=False):
+    """
+    :param binary: write each day as a LabelClustering .npz instead of a CSV of clusters
+    """
+    for key, value in clusterings.items():
+        if binary:
+            LabelClustering.from_lists(value).save(odir + str(key) + '.npz')
+            continue
+        ofile = odir + str(key) + '.csv'
+        writer = csv.writer(open(ofile, 'w'), delimiter=',')
+        writer.writerows(value)
 
 
 def do_naive_clustering():
     dists, pos = get_naive_distance()
     clusterings = dict()
     for i in range(2, 31):
-        dist_mat = dists[i]
-        res = minimize(compute_naive_clustering, .3, method='nelder-mead', args=(dist_mat, pos))
-        cl = AgglomerativeCluster(pos, dist_mat, res.x[0])
-        clusterings[i] = cl
+        clusterings[i] = cluster_day(dists[i], pos)
         print("Completed day: ", i)
     print("Completed Clustering")
-    for key, value in clusterings.items():
-        ofile = './clusterings/naive/' + str(key) + '.csv'
-        writer = csv.writer(open(ofile, 'w'), delimiter=',')
-        writer.writerows(value)
+    write_clusterings('./clusterings/naive/', clusterings)
 
-def do_learned_clustering():
+def do_learned_clustering(warm_start=False):
     pos, conn_mats, ph_mats, jacc_mats, nat_mats = get_input_matrices()
+    optimizer = LearnedOptimizer(pos, warm_start=warm_start)
     clusterings = dict()
     for key in range(2, 31):
         c_mat, p_mat, j_mat, n_mat = conn_mats[key], ph_mats[key], jacc_mats[key], nat_mats[key]
-        res = minimize(compute_learned_clustering, [.5, .5, .5, .5, .5], method='nelder-mead',
-                       args=(pos, c_mat, p_mat, j_mat, n_mat))
-        max_dist, conn_p, nat_p, jacc_p, ph_p = res.x
-        learned_mat = (1 / (conn_p + nat_p + jacc_p + ph_p)) * (conn_p * c_mat + nat_p * n_mat + jacc_p * j_mat+ ph_p * p_mat)
-        clusterings[key] = AgglomerativeCluster(pos, learned_mat, max_dist)
-        print("Completed clustering for day: ", key)
-        print(res.x[0])
+        _, clusterings[key] = optimizer.optimize_day(key, c_mat, p_mat, j_mat, n_mat)
+        day, nfev, evals, hits, secs, score = optimizer.stats[-1]
+        print("Completed clustering for day: ", key, " evaluations: ", evals, " cache hits: ", hits, " time: ", secs)
 
-    for key, value in clusterings.items():
-        ofile = './clusterings/learned/' + str(key) + '.csv'
-        writer = csv.writer(open(ofile, 'w'), delimiter=',')
-        writer.writerows(value)
+    write_clusterings('./clusterings/learned/', clusterings)
+
+    writer = csv.writer(open('./clusterings/learned_stats.csv', 'w'), delimiter=',')
+    writer.writerow(['Day', 'Objective_calls', 'Evaluations', 'Cache_hits', 'Seconds', 'Score'])
+    writer.writerows(optimizer.stats)
 
 
-def do_metric_clustering():
+def do_metric_clustering(metric='jaccard'):
+    """
+    :param metric: one of connectivity, phone_cost, jaccard or nationality
+    """
     pos, conn_mats, ph_mats, jacc_mats, nat_mats = get_input_matrices()
+    mats = dict(zip(METRICS, (conn_mats, ph_mats, jacc_mats, nat_mats)))[metric]
     clusterings = dict()
 
     for i in range(2, 31):
-        dist_mat = jacc_mats[i] ## Change to change indiviudal cluster
-        res = minimize(compute_naive_clustering, .85, method='nelder-mead', args=(dist_mat, pos))
-        cl = AgglomerativeCluster(pos, dist_mat, res.x[0])
-        clusterings[i] = cl
+        clusterings[i] = cluster_day(mats[i], pos)
         print("Completed day: ", i)
 
-
-    for key, value in clusterings.items():
-        ofile = './clusterings/individual/jaccard/' + str(key) + '.csv' # Change location per metric
-        writer = csv.writer(open(ofile, 'w'), delimiter=',')
-        writer.writerows(value)
+    write_clusterings('./clusterings/individual/' + metric + '/', clusterings)
 
 # Conn: .7, phone: .005, nat: .005, jac: .85
 
-def read_clustering(ifile):
-    olst = list()
-    reader = csv.reader(open(ifile), delimiter=',')
-    for row in reader:
-        olst.append(row)
-    return olst
-
-def compute_consensus_mat(c, j, n, p, tows):
-    mat = np.zeros((len(tows), len(tows)))
-    for clustering in [c,j,n,p]:
-        for cl in clustering:
-            for c1, c2 in combinations(cl, 2):
-                p1, p2 = tows.index(c1), tows.index(c2)
-                mat[p1, p2] += 1
-                mat[p2, p1] += 1
-                assert np.count_nonzero(mat) > 0
-    mat += 1
-    mat = 1/mat
-    np.fill_diagonal(mat, 0)
+def clustering_labels(clustering, tower_pos):
+    """
+    :param clustering: a list of clusters of towers
+    :param tower_pos: a tower -> position dictionary
+    :return: an integer label per tower position. Towers missing from the clustering get a
+        distinct negative label so they share a cluster with no other tower.
+    """
+    labels = -np.arange(1, len(tower_pos) + 1)
+    for label, cl in enumerate(clustering):
+        for t in cl:
+            labels[tower_pos[t]] = label
+    return labels
+
+
+def consensus_matrix(labels):
+    """
+    The co-association distance of several clusterings: 1/(1 + the number of clusterings that
+    put two towers together), with a zero diagonal
+    :param labels: a (..., K, T) array of K label vectors, e.g. (K, T) for one day or (days, K, T)
+    :return: a (..., T, T) array
+    """
+    labels = np.asarray(labels)
+    counts = (labels[..., :, None] == labels[..., None, :]).sum(axis=-3)
+    mat = 1/(counts + 1.0)
+    diag = np.arange(labels.shape[-1])
+    mat[..., diag, diag] = 0
     return mat
 
 
+def compute_consensus_mat(c, j, n, p, tows):
+    tower_pos = dict((t, i) for i, t in enumerate(tows))
+    return consensus_matrix([clustering_labels(cl, tower_pos) for cl in (c, j, n, p)])
 
 
-def get_clusterings():
-    conn_dir = './clusterings/individual/connectivity/'
-    jacc_dir = './clusterings/individual/jaccard/'
-    nat_dir = './clusterings/individual/nationality/'
-    phone_dir = './clusterings/individual/phone_cost/'
+def get_clusterings(clust_dirs=None):
+    """
+    :param clust_dirs: the directories of the clusterings to combine, defaults to the four individual metrics
+    :return: the sorted towers and a day -> consensus matrix dictionary
+    """
+    if clust_dirs is None:
+        clust_dirs = ['./clusterings/individual/' + m + '/' for m in ('connectivity', 'jaccard', 'nationality', 'phone_cost')]
 
-    day_mats = dict()
-    all_towers = None
-    for ifile in os.listdir(conn_dir):
-        day = int(ifile.replace('.csv', ''))
+    clusterings = [read_clustering_dir(cdir) for cdir in clust_dirs]
+    days = sorted(clusterings[0].keys())
 
-        conn_clusts = [[int(i) for i in l] for l in read_clustering(conn_dir + ifile)]
-        jacc_clusts = [[int(i) for i in l] for l in read_clustering(jacc_dir + ifile)]
-        nat_clusts = [[int(i) for i in l] for l in read_clustering(nat_dir + ifile)]
-        phone_clusts = [[int(i) for i in l] for l in read_clustering(phone_dir + ifile)]
-        if not all_towers:
-            all_towers = sorted([t for l in conn_clusts for t in l])
-        day_mats[day] = compute_consensus_mat(conn_clusts, jacc_clusts, nat_clusts, phone_clusts, all_towers)
+    all_towers = sorted(clusterings[0][days[0]].towers.tolist())
+    labels = np.array([[clusts[day].align(all_towers) for clusts in clusterings] for day in days])
+    mats = consensus_matrix(labels)
 
+    day_mats = dict((day, mats[i]) for i, day in enumerate(days))
     return all_towers, day_mats
 
 def do_consensus_clustering():
     pos, dists = get_clusterings()
     clusterings = dict()
     for i in range(2, 31):
-        dist_mat = dists[i]
-        res = minimize(compute_naive_clustering, .5, method='nelder-mead', args=(dist_mat, pos))
-        cl = AgglomerativeCluster(pos, dist_mat, res.x[0])
-        clusterings[i] = cl
+        clusterings[i] = cluster_day(dists[i], pos)
         print("Completed day: ", i)
     print("Completed Clustering")
-    for key, value in clusterings.items():
-        ofile = './clusterings/consensus/' + str(key) + '.csv'
-        writer = csv.writer(open(ofile, 'w'), delimiter=',')
-        writer.writerows(value)
+    write_clusterings('./clusterings/consensus/', clusterings)
+
+
+def _kind_dir(kind):
+    if kind.startswith('metric:'):
+        return './clusterings/individual/' + kind.split(':', 1)[1] + '/'
+    return './clusterings/' + kind + '/'
+
+
+def _kind_matrices(kind):
+    """
+    :return: the tower positions, the days and a (days, T, T) stack, or (4, days, T, T) for learned
+    """
+    if kind == 'naive':
+        dists, pos = get_naive_distance()
+        days, stack = to_stack(dists)
+    elif kind == 'consensus':
+        pos, dists = get_clusterings()
+        days, stack = to_stack(dists)
+    else:
+        pos, conn_mats, ph_mats, jacc_mats, nat_mats = get_input_matrices()
+        feature_mats = dict(zip(METRICS, (conn_mats, ph_mats, jacc_mats, nat_mats)))
+        if kind == 'learned':
+            days = sorted(conn_mats.keys())
+            stack = np.array([to_stack(feature_mats[m])[1] for m in METRICS])
+        elif kind.startswith('metric:') and kind.split(':', 1)[1] in METRICS:
+            days, stack = to_stack(feature_mats[kind.split(':', 1)[1]])
+        else:
+            raise ValueError("Unknown clustering kind: " + kind)
+    return list(pos), days, stack
+
+
+def _cluster_shared_day(kind, idx, spec, pos):
+    stack = attach_array(spec)
+    if kind == 'learned':
+        c_mat, p_mat, j_mat, n_mat = stack[:, idx]
+        return learned_cluster_day(pos, c_mat, p_mat, j_mat, n_mat)
+    return cluster_day(stack[idx], pos)
+
+
+# The daily matrices of a kind are copied once into shared memory and each worker attaches to them,
+# so a task only carries the kind, the day and the array spec.
+def run_clusterings(kinds, processes=None, day_range=range(2, 31)):
+    """
+    Clusters every day of the given kinds on one process pool and writes the outputs.
+    Consensus runs after the other kinds, since it reads the individual metric clusterings.
+    :param kinds: a list of kinds:
+        -- naive: the averaged symmetric metric, written to clusterings/naive/
+        -- learned: the optimized weighted metric, written to clusterings/learned/. Days are independent
+           tasks, so each starts from the default x0 as in do_learned_clustering; a warm start chains
+           the days and is only available there.
+        -- metric:<name>: a single feature in METRICS, written to clusterings/individual/<name>/
+        -- consensus: the co-association of the four individual clusterings, written to clusterings/consensus/
+    :param processes: the number of workers, defaults to the number of cores
+    """
+    ordered = [k for k in kinds if k != 'consensus'] + [k for k in kinds if k == 'consensus']
+    stages = [[k for k in ordered if k != 'consensus'], [k for k in ordered if k == 'consensus']]
+
+    with mp.Pool(processes=processes) as p:
+        for stage in stages:
+            pending, blocks = list(), list()
+            for kind in stage:
+                pos, days, stack = _kind_matrices(kind)
+                shm, spec = share_array(stack)
+                blocks.append(shm)
+                tasks = [(day, p.apply_async(_cluster_shared_day, args=(kind, i, spec, pos)))
+                         for i, day in enumerate(days) if day in day_range]
+                pending.append((kind, tasks))
+
+            for kind, tasks in pending:
+                clusterings = dict((day, r.get()) for day, r in tasks)
+                write_clusterings(_kind_dir(kind), clusterings)
+                print("Completed clustering: ", kind)
+
+            for shm in blocks:
+                release(shm)
+
 
 if __name__ == "__main__":
-    do_naive_clustering()
-    # do_learned_clustering()
-    # do_metric_clustering()
-    # do_consensus_clustering()
+    # e.g. python clustering_component.py naive learned metric:jaccard metric:connectivity consensus
+    run_clusterings(sys.argv[1:] or ['naive'])
@@ -0,0 +1,134 @@
+"""
+A variable-order next-tower predictor. Every context of up to max_order stops is stored in one trie keyed
+on the stops in reverse, and each node tracks its most frequent next tower, ties going to the first in
+towers order. A prediction answers from the longest context seen in training in O(max_order), with the
+root as the order-0 fallback. A transition is a stop and the stop right after it, for every context length.
+"""
+import csv
+import time
+
+from markov_model import mn_std
+from markov_model_priors import generate_transitions, get_paths_byday, get_towers
+
+
+class _Node:
+    __slots__ = ('children', 'counts', 'best', 'best_count')
+
+    def __init__(self):
+        self.children = dict()
+        self.counts = dict()
+        self.best, self.best_count = None, 0
+
+
+class ContextTrie:
+
+    def __init__(self, max_order, towers=None):
+        """
+        :param max_order: the longest context stored
+        :param towers: if given, only transitions between these towers are counted
+        """
+        self.max_order = max_order
+        self.tower_rank = None if towers is None else dict((t, i) for i, t in enumerate(towers))
+        self.root = _Node()
+        self.n_nodes = 1
+
+    def _known(self, tower):
+        return self.tower_rank is None or tower in self.tower_rank
+
+    def _count(self, node, nxt):
+        count = node.counts.get(nxt, 0) + 1
+        node.counts[nxt] = count
+        if count > node.best_count or (count == node.best_count and self._before(nxt, node.best)):
+            node.best, node.best_count = nxt, count
+
+    def _before(self, t1, t2):
+        if self.tower_rank is None:
+            return t1 < t2
+        return self.tower_rank[t1] < self.tower_rank[t2]
+
+    def add_path(self, path):
+        for i, (_, nxt) in enumerate(generate_transitions(path, 1)):
+            if not self._known(nxt):
+                continue
+            node = self.root
+            self._count(node, nxt)
+            for j in range(i, max(-1, i - self.max_order), -1):
+                if not self._known(path[j]):
+                    break
+                child = node.children.get(path[j], None)
+                if child is None:
+                    child = node.children[path[j]] = _Node()
+                    self.n_nodes += 1
+                node = child
+                self._count(node, nxt)
+
+    def add_paths(self, paths):
+        for path in paths:
+            self.add_path(path)
+
+    def predict(self, history, order=None):
+        """
+        :param history: the stops so far, the current tower last
+        :param order: the longest context to use, defaults to max_order
+        :return: the predicted next tower and the length of the context it came from, (None, 0) if
+            nothing was trained
+        """
+        order = self.max_order if order is None else min(order, self.max_order)
+        node, depth = self.root, 0
+        for tower in reversed(history[-order:]):
+            child = node.children.get(tower, None)
+            if child is None:
+                break
+            node, depth = child, depth + 1
+        return node.best, depth
+
+
+def score_day(trie, day_paths, order=None):
+    """
+    :return: a 1 or 0 for every transition of the paths, whether the trie predicted the next stop
+    """
+    out = list()
+    for path in day_paths:
+        for i, (_, dest) in enumerate(generate_transitions(path, 1)):
+            if trie._known(path[i]) and trie._known(dest):
+                pred, _ = trie.predict(path[max(0, i + 1 - trie.max_order):i + 1], order)
+                out.append(1 if pred == dest else 0)
+    return out
+
+
+def compute_trie_precision(day_range, max_order, user_paths, towers):
+    """
+    Trains one trie on the paths day by day and scores it at every order up to max_order. As in
+    markov_model.compute_transition_precision, the result for a day scores the paths of the day
+    before it against a model trained on the days up to and including that day.
+    :return: an order -> list of (day, mean, std) dictionary
+    """
+    trie = ContextTrie(max_order, towers)
+    trained = 1
+    results = dict((order, list()) for order in range(1, max_order + 1))
+    for day in day_range:
+        for tday in range(trained + 1, day):
+            trie.add_paths(user_paths.get(tday, list()))
+        trained = max(trained, day - 1)
+
+        for order in range(1, max_order + 1):
+            m, std = mn_std(score_day(trie, user_paths.get(day-1, list()), order))
+            results[order].append((day, m, std))
+    print("Trie nodes: ", trie.n_nodes)
+    return results
+
+
+def run_trie_model(max_order=5):
+    towers = get_towers()
+    user_paths = get_paths_byday()
+
+    istart = time.time()
+    results = compute_trie_precision(range(20, 31), max_order, user_paths, towers)
+    print("Completed trie model in: ", time.time() - istart)
+
+    writer = csv.writer(open("./processed_data/mmperf_trie_ord5_r20_30.csv", 'w'), delimiter=',')
+    writer.writerows(results[order] for order in sorted(results))
+
+
+if __name__ == "__main__":
+    run_trie_model(max_order=5)
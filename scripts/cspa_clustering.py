@@ -2,6 +2,8 @@ import numpy as np
 import csv, os
 from itertools import combinations
 from markov_model_priors import get_paths_byday
+from label_clustering import read_clustering_dir
+from snapshots import CumulativeSnapshots
 
 
 def norm_mat(mat):
@@ -15,63 +17,38 @@ def norm_mat(mat):
 
 
 def import_clusterings(idir):
-    clusterings = dict()
-
-    for ifile in os.listdir(idir):
-        day = int(ifile.replace('.csv', ''))
-        reader = csv.reader(open(idir+ifile), delimiter=',')
-        clusterings[day] = [[int(t) for t in c] for c in reader]
-
-    towers = sorted(list(i for cl in clusterings[2] for i in cl))
+    clusterings = read_clustering_dir(idir)
+    towers = sorted(clusterings[2].towers.tolist())
     return clusterings, towers
 
 
 def convert_to_similarity(clusterings, towers):
+    """
+    :return: a day -> TxT matrix with 1 where two towers share a cluster. The diagonal is 1 only
+        for towers that are alone in their cluster.
+    """
     clust_mats = dict()
-
-    tposdct = dict()
-    for i, t in enumerate(towers):
-        tposdct[t] = i
+    diag = np.arange(len(towers))
 
     for day, clusts in clusterings.items():
-        mat = np.zeros((len(towers), len(towers)))
-        for clust in clusts:
-            for t1, t2 in combinations(clust, 2):
-                p1, p2 = tposdct[t1], tposdct[t2]
-                mat[p1,p2] = 1
-                mat[p2,p1] = 1
-            if len(clust) == 1:
-                p1 = tposdct[clust[0]]
-                mat[p1, p1] = 1
+        labels = clusts.align(towers)
+        mat = (labels[:, None] == labels[None, :]).astype(float)
+        mat[diag, diag] = np.bincount(labels)[labels] == 1
         clust_mats[day] = mat
 
     return clust_mats
 
 
 def aggregate_clusterings(clusts):
-    agg_clusts = dict()
-    curr_clust = clusts[2]
-    agg_clusts[2] = norm_mat(curr_clust)
-
-    for day in range(3, 31):
-        curr_clust += clusts[day]
-        agg_clusts[day] = norm_mat(curr_clust)
-
-    return agg_clusts
+    """
+    :return: CumulativeSnapshots mapping a day to the row-normalized sum of the similarity
+        matrices of days 2 to that day. The input matrices are not modified.
+    """
+    return CumulativeSnapshots(dict((day, clusts[day]) for day in range(2, 31)), norm_mat)
 
 
 def aggregate_two_clusterings(clusts1, clusts2):
-    agg_clusts = dict()
-    curr_clust = clusts1[2] + clusts2[2]
-    agg_clusts[2] = norm_mat(curr_clust)
-
-    for day in range(3, 31):
-        curr_clust += clusts1[day]
-        curr_clust += clusts2[day]
-
-        agg_clusts[day] = norm_mat(curr_clust)
-
-    return agg_clusts
+    return CumulativeSnapshots(dict((day, clusts1[day] + clusts2[day]) for day in range(2, 31)), norm_mat)
 
 
 def pairwise_iterator(lst):
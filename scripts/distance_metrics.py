@@ -1,60 +1,206 @@
+"""
+The feature matrices are loaded once per process and cached read-only, keyed on the paths and
+modification times of the feature files. The metrics always build new arrays from the cache.
+"""
+import os
 import numpy as np
-from itertools import combinations
+from collections import namedtuple
 
+import get_regional_dists as grd
 from get_regional_dists import _get_connectivity, _get_jaccard, _get_nationality, _get_phonecost_matrix
 
+FeatureMatrices = namedtuple('FeatureMatrices', 'towers conn phone jacc nat')
 
-def _averageForSymmetry(arr):
-    for i,j in combinations(range(0, arr.shape[0]), 2):
-        v1, v2 = arr[i,j], arr[j,i]
-        avg = float(v1+v2)/2.0
-        arr[i,j] = avg
-        arr[j,i] = avg
-    return arr
-
-
-def get_learned_metric(c_param, p_param, j_param, n_param):
-    distances = dict()
+_feature_cache = dict()
+_symmetric_cache = dict()
+_stack_cache = dict()
 
-    tower_header, c_mats = _get_connectivity()
-    _, p_mats = _get_phonecost_matrix()
-    _, j_mats = _get_jaccard()
-    nationalities, n_mats = _get_nationality(tower_header)
 
-    for key, value in c_mats.items():
-        distances[key] = (1/(c_param+ p_param+j_param+n_param))*(c_param * value + p_param*p_mats[key] + j_param * j_mats[key] + n_param * n_mats[key])
+def symmetrize_stack(stack):
+    """
+    Averages each matrix with its transpose without modifying the input
+    :param stack: a (..., T, T) array, e.g. a single matrix or a (days, T, T) stack
+    :return: a new array of the same shape
+    """
+    stack = np.asarray(stack, dtype=float)
+    return (stack + np.swapaxes(stack, -1, -2))/2.0
 
-    return distances, tower_header
 
+def _averageForSymmetry(arr):
+    return symmetrize_stack(arr)
+
+
+def to_stack(mats):
+    """
+    :param mats: a day -> matrix dictionary
+    :return: the sorted days and the (days, T, T) stack of their matrices
+    """
+    days = sorted(mats.keys())
+    return days, np.array([mats[d] for d in days])
+
+
+def feature_stack(features):
+    """
+    :param features: a FeatureMatrices object
+    :return: the sorted days and a (4, days, T, T) stack in the order conn, phone, jacc, nat
+    """
+    days = sorted(features.conn.keys())
+    return days, np.array([[getattr(features, name)[d] for d in days] for name in FeatureMatrices._fields[1:]])
+
+
+def blend_stack(stacks, weights):
+    """
+    Weighted averages of feature stacks, for one or many weight vectors at once
+    :param stacks: a (F, ...) array of F features, e.g. from feature_stack or a (F, T, T) single day
+    :param weights: a (F,) weight vector or a (K, F) array of K candidate weight vectors
+    :return: sum_f w_f * stacks[f] / sum_f w_f, with shape (...) or (K, ...)
+    """
+    weights = np.asarray(weights, dtype=float)
+    normed = weights/weights.sum(axis=-1, keepdims=True)
+    return np.tensordot(normed, stacks, axes=(-1, 0))
+
+
+def _day_dict(days, stack):
+    return dict((d, stack[i]) for i, d in enumerate(days))
+
+
+def _input_key():
+    """
+    :return: a tuple of (path, mtime) for every feature file the _get_* loaders may read
+    """
+    key = list()
+    paths = [grd.PHONE_COST_FILE, grd.PHONE_COST_STACK + 'stack.npy',
+             grd.JACCARD_DIR, grd.CONNECTIVITY_DIR, grd.NATIONALITY_DIR]
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for ifile in sorted(os.listdir(path)):
+                fpath = os.path.join(path, ifile)
+                key.append((fpath, os.path.getmtime(fpath)))
+        elif os.path.exists(path):
+            key.append((path, os.path.getmtime(path)))
+    return tuple(key)
+
+
+def _read_only(mats):
+    for mat in mats.values():
+        mat.setflags(write=False)
+    return mats
+
+
+def clear_feature_cache():
+    _feature_cache.clear()
+    _symmetric_cache.clear()
+    _stack_cache.clear()
+
+
+def load_feature_matrices():
+    """
+    Loads the connectivity, phone cost, jaccard and nationality matrices, or returns them from the cache
+    :return: a FeatureMatrices object of day -> matrix dictionaries
+    """
+    key = _input_key()
+    features = _feature_cache.get(key, None)
+    if features is None:
+        tower_header, c_mats = _get_connectivity()
+        _, p_mats = _get_phonecost_matrix()
+        _, j_mats = _get_jaccard()
+        _, n_mats = _get_nationality(tower_header)
+        features = FeatureMatrices(towers=tower_header,
+                                   conn=_read_only(dict((k, np.array(v)) for k, v in c_mats.items())),
+                                   phone=_read_only(dict((k, np.array(v)) for k, v in p_mats.items())),
+                                   jacc=_read_only(dict((k, np.array(v)) for k, v in j_mats.items())),
+                                   nat=_read_only(dict((k, np.array(v)) for k, v in n_mats.items())))
+        _feature_cache.clear()
+        _feature_cache[key] = features
+    return features
+
+
+def _save_symmetric(fpath, key, features):
+    arrays = {'key': np.array(repr(key)), 'towers': np.asarray(features.towers)}
+    for name in FeatureMatrices._fields[1:]:
+        mats = getattr(features, name)
+        days = sorted(mats.keys())
+        arrays[name + '_days'] = np.array(days)
+        arrays[name] = np.array([mats[d] for d in days])
+    np.savez(fpath, **arrays)
+
+
+def _load_symmetric(fpath, key):
+    if not os.path.exists(fpath):
+        return None
+    arrays = np.load(fpath)
+    if str(arrays['key']) != repr(key):
+        return None
+    mats = [dict(zip(arrays[name + '_days'].tolist(), arrays[name]))
+            for name in FeatureMatrices._fields[1:]]
+    return FeatureMatrices(arrays['towers'], *[_read_only(m) for m in mats])
+
+
+def load_symmetric_matrices(disk_cache=None):
+    """
+    The feature matrices averaged with their transposes, cached in the same way as load_feature_matrices
+    :param disk_cache: optional path of an .npz file holding the symmetrized matrices. It is read
+        when its stored key matches the feature files and rewritten otherwise.
+    :return: a FeatureMatrices object
+    """
+    key = _input_key()
+    features = _symmetric_cache.get(key, None)
+    if features is None and disk_cache is not None:
+        features = _load_symmetric(disk_cache, key)
+    if features is None:
+        raw = load_feature_matrices()
+        days, stacks = feature_stack(raw)
+        features = FeatureMatrices(raw.towers, *[_read_only(_day_dict(days, sym)) for sym in symmetrize_stack(stacks)])
+        if disk_cache is not None:
+            _save_symmetric(disk_cache, key, features)
+    _symmetric_cache.clear()
+    _symmetric_cache[key] = features
+    return features
+
+
+def load_feature_stack(symmetric=False, disk_cache=None):
+    """
+    The feature_stack of the raw or symmetrized matrices, built once per set of feature files
+    :return: the sorted days, the tower header and a read-only (4, days, T, T) stack
+    """
+    key = _input_key()
+    cached = _stack_cache.get((key, symmetric), None)
+    if cached is None:
+        features = load_symmetric_matrices(disk_cache) if symmetric else load_feature_matrices()
+        days, stacks = feature_stack(features)
+        stacks.setflags(write=False)
+        cached = (days, features.towers, stacks)
+        for old_key in [k for k in _stack_cache if k[0] != key]:
+            del _stack_cache[old_key]
+        _stack_cache[(key, symmetric)] = cached
+    return cached
+
+
+def get_blended_metrics(weights, symmetric=False, disk_cache=None):
+    """
+    Blends the feature matrices of every day for one or many weight vectors in one call
+    :param weights: a (4,) or (K, 4) array of (conn, phone, jacc, nat) weights
+    :param symmetric: blend the symmetrized matrices instead of the raw ones
+    :return: the sorted days, the tower header and a (days, T, T) or (K, days, T, T) array
+    """
+    days, towers, stacks = load_feature_stack(symmetric, disk_cache)
+    return days, towers, blend_stack(stacks, weights)
 
-def get_naive_distance():
-    distances = dict()
 
-    tower_header, c_mats = _get_connectivity()
-    _, p_mats = _get_phonecost_matrix()
-    _, j_mats = _get_jaccard()
-    nationalities, n_mats = _get_nationality(tower_header)
+def get_learned_metric(c_param, p_param, j_param, n_param):
+    days, tower_header, blended = get_blended_metrics([c_param, p_param, j_param, n_param])
+    return _day_dict(days, blended), tower_header
 
-    for key, value in c_mats.items():
-        distances[key] = .25*(_averageForSymmetry(value) + _averageForSymmetry(p_mats[key]) + _averageForSymmetry(j_mats[key]) + _averageForSymmetry(n_mats[key]))
 
-    return distances, tower_header
+def get_naive_distance(disk_cache=None):
+    days, tower_header, blended = get_blended_metrics([1, 1, 1, 1], symmetric=True, disk_cache=disk_cache)
+    return _day_dict(days, blended), tower_header
 
 def avg_all_forsym(mats):
-    odct = dict()
-    for key, value in mats.items():
-        odct[key] = _averageForSymmetry(value)
-    return odct
-
-def get_input_matrices():
-    distances = dict()
-
-    tower_header, c_mats = _get_connectivity()
-    _, p_mats = _get_phonecost_matrix()
-    _, j_mats = _get_jaccard()
-    nationalities, n_mats = _get_nationality(tower_header)
-
-
-
-    return tower_header, avg_all_forsym(c_mats), avg_all_forsym(p_mats), avg_all_forsym(j_mats), avg_all_forsym(n_mats)
+    days, stack = to_stack(mats)
+    return _day_dict(days, symmetrize_stack(stack))
 
+def get_input_matrices(disk_cache=None):
+    features = load_symmetric_matrices(disk_cache)
+    return features.towers, dict(features.conn), dict(features.phone), dict(features.jacc), dict(features.nat)
@@ -1,17 +1,27 @@
 import csv
 from helper_funcs import get_csv_files, compare_times
 from collections import defaultdict
+from user_store import get_store_towers, load_tower, load_user_ids
 
 
-def get_individual_paths(idir, ofile):
+def get_individual_paths(idir, ofile, store_dir=None):
     user_dict = defaultdict(set)
-    for ifile in get_csv_files(idir):
-        tower = int(ifile.replace('.csv',''))
-        reader = csv.reader(open(idir + ifile))
-        for row in reader:
-            user, date = row[0], row[1:5]
-            rec = [tower] + date
-            user_dict[user].add(';'.join([str(i) for i in rec]))
+    if store_dir is not None:
+        user_ids = load_user_ids(store_dir)
+        for tower in get_store_towers(store_dir):
+            recs = load_tower(store_dir, tower)
+            users = user_ids[recs['user']]
+            for user, d, h, m, s in zip(users, recs['day'].tolist(), recs['hour'].tolist(),
+                                        recs['minute'].tolist(), recs['second'].tolist()):
+                user_dict[user].add(';'.join([str(i) for i in (tower, d, h, m, s)]))
+    else:
+        for ifile in get_csv_files(idir):
+            tower = int(ifile.replace('.csv',''))
+            reader = csv.reader(open(idir + ifile))
+            for row in reader:
+                user, date = row[0], row[1:5]
+                rec = [tower] + date
+                user_dict[user].add(';'.join([str(i) for i in rec]))
 
     writer = csv.writer(open(ofile, 'w'), delimiter=',')
     user_ct, total_stops = 0, 0
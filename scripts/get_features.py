@@ -1,8 +1,11 @@
 import os, csv
 from collections import namedtuple, defaultdict, Counter
-from helper_funcs import read_pointers, jaccard_fn, get_csv_files
-from itertools import combinations
+from helper_funcs import read_pointers, get_csv_files
 import numpy as np
+from scipy.sparse import csr_matrix
+from matrix_store import save_stack
+from minhash import EMPTY, get_permutations, signature, signature_jaccard_matrix
+from user_store import get_store_towers, load_tower, load_user_ids
 
 """
 The out-directory path to be written, directory written as follows:
@@ -36,80 +39,124 @@ def construct_odir(odir):
     return odirs
 
 
-def compute_jaccard_feature(idir, odir, days):
+def _tower_positions(idir):
     """
-    Computes the jaccard feature for each tower and outputs to numpy matrices
-    :param idir: the input directory of user files
-    :param odir: the output directory
-    :param days: number of days in the month
-    :outputs: modifies the output directory with daily pairwise distance functions
+    Lists the tower files of the input directory
+    :return: a list of (tower, filename) pairs, the index of a pair is the tower's position in the
+        eventual matrices
     """
-    users = dict()
-    towers, position = dict(), 0
-    for ifile in get_csv_files(idir):
-        tower = int(ifile.replace('.csv', ''))
-        towers[tower] = position # Maps to position in eventual matrix
-        position += 1
+    return [(int(ifile.replace('.csv', '')), ifile) for ifile in get_csv_files(idir)]
 
-        tdict = defaultdict(set)
 
-        reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
-        for row in reader:
-            user, day = row[0], int(row[1])
-            tdict[day].add(user)
+def _store_towers(store_dir):
+    """
+    Memory-maps the records of every tower of a user_store directory
+    :return: a list of (tower, records) pairs
+    """
+    return [(tower, load_tower(store_dir, tower)) for tower in get_store_towers(store_dir)]
 
-        users[tower] = tdict
 
-    tower_lst_ps = [(k,v) for k,v in towers.items()]
-    tower_lst_ps.sort(key=lambda x:x[1])
-    towers_lst = [p[0] for p in tower_lst_ps]
+def _by_day(days, values):
+    """
+    Groups a column of a tower's records by day
+    :return: a day -> array of values dictionary
+    """
+    order = np.argsort(days, kind='stable')
+    uniq, starts = np.unique(days[order], return_index=True)
+    return dict(zip(uniq.tolist(), np.split(values[order], starts[1:])))
 
-    num_tows = len(towers.keys())
-    for day in range(1, days + 1):
-        ofile = odir + str(day) + '.csv'
-        mat = np.zeros((num_tows, num_tows))
-        for t1, t2 in combinations(towers.keys(), 2):
-            p1, p2 = towers.get(t1, 0), towers.get(t2, 0)
-            s1 = users[t1].get(day, set())
-            s2 = users[t2].get(day, set())
-            jacc = jaccard_fn(s1, s2)
-            mat[p1, p2] = jacc
-            mat[p2, p1] = jacc
 
-        omat = np.append([towers_lst], mat, axis=0)
-        np.savetxt(ofile, omat)
+def _store_users(recs, user_ids=None):
+    """
+    :param user_ids: the user table of the store. The interned ids are enough to compare sets, the
+        identifiers themselves are only needed where they are hashed.
+    :return: a day -> set of users dictionary
+    """
+    users = recs['user'] if user_ids is None else user_ids[recs['user']]
+    return dict((day, set(vals.tolist())) for day, vals in _by_day(recs['day'], users).items())
 
 
-def compute_phonecosts(idir, ofile, days):
+def _store_costs(recs):
     """
-    Compute the per-tower average phone costs
-    :param idir: the input directory of user data
-    :param ofile: the output file to write to
-    :param days: number of days in the month
-    :return: writes the average phone cost in each tower per day.
-        The top row is the list of towers
+    :return: a day -> (total cost, record count) dictionary
     """
-    print(ofile)
-    users = dict()
-    towers, position = dict(), 0
-    for ifile in get_csv_files(idir):
-        tower = int(ifile.replace('.csv', ''))
-        towers[tower] = position # Maps to position in eventual matrix
-        position += 1
+    return dict((day, (int(vals.sum()), len(vals)))
+                for day, vals in _by_day(recs['day'], recs['cost'].astype(np.int64)).items())
 
-        tdict = defaultdict(list)
 
-        reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
-        for row in reader:
-            day, cost = int(row[1]), int(row[7])
-            tdict[day].append(cost)
+def _store_counts(recs, field, ptrs):
+    """
+    Counts the pointed values of an integer column per day. The pointers are looked up with the
+    column's text, as the user files store it, and records without a pointer are skipped.
+    :return: a day -> Counter dictionary
+    """
+    uniq, inv = np.unique(recs[field], return_inverse=True)
+    known = np.array([str(v) in ptrs for v in uniq.tolist()], dtype=bool)
+    values = np.array([ptrs.get(str(v), None) for v in uniq.tolist()], dtype=object)
+    keep = known[inv]
+    return dict((day, Counter(vals.tolist())) for day, vals in _by_day(recs['day'][keep], values[inv[keep]]).items())
 
-        users[tower] = tdict
 
-    tower_lst_ps = [(k,v) for k,v in towers.items()]
-    tower_lst_ps.sort(key=lambda x:x[1])
-    towers_lst = [p[0] for p in tower_lst_ps]
+def jaccard_matrix(sets):
+    """
+    Computes the pairwise jaccard dissimilarities of a list of sets with a sparse incidence matrix.
+    Intersections come from one sparse product, unions from the set sizes.
+    :param sets: a list of sets, one per tower position
+    :return: a TxT matrix matching jaccard_fn on every off-diagonal pair, with a zero diagonal
+    """
+    num_sets = len(sets)
+    user_pos, rows, cols = dict(), list(), list()
+    for i, s in enumerate(sets):
+        for user in s:
+            rows.append(i)
+            cols.append(user_pos.setdefault(user, len(user_pos)))
+
+    incidence = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_sets, len(user_pos)))
+    intersect = (incidence @ incidence.T).toarray()
+    sizes = np.array([len(s) for s in sets], dtype=float)
+    union = sizes[:, None] + sizes[None, :] - intersect
+
+    mat = np.ones((num_sets, num_sets))
+    nonempty = union > 0
+    mat[nonempty] = 1 - intersect[nonempty]/union[nonempty]
+    np.fill_diagonal(mat, 0)
+    return mat
+
+
+def _minhash_days(tdict, num_perm):
+    """
+    Replaces the per-day user sets of a tower with fixed-size MinHash signatures
+    """
+    perms = get_permutations(num_perm)
+    return dict((day, signature(users, perms)) for day, users in tdict.items())
 
+
+def _write_jaccard(users, towers_lst, odir, days, num_perm=None, binary=False):
+    """
+    :param users: tower -> day -> set of users, or tower -> day -> MinHash signature when num_perm is set
+    :param num_perm: the signature size of the approximate mode, None for exact jaccard
+    :param binary: when True, writes a single (days, T, T) stack with matrix_store instead of daily text files
+    """
+    mats = list()
+    for day in range(1, days + 1):
+        ofile = odir + str(day) + '.csv'
+        if num_perm is None:
+            mat = jaccard_matrix([users[t].get(day, set()) for t in towers_lst])
+        else:
+            empty = np.full(num_perm, EMPTY, dtype=np.uint64)
+            mat = signature_jaccard_matrix(np.array([users[t].get(day, empty) for t in towers_lst]))
+
+        if binary:
+            mats.append(mat)
+        else:
+            omat = np.append([towers_lst], mat, axis=0)
+            np.savetxt(ofile, omat)
+
+    if binary:
+        save_stack(odir, mats, towers_lst, towers_lst)
+
+
+def _write_phonecosts(users, towers_lst, ofile, days, binary=False):
     rows = list()
     first_row = [-1]
     first_row.extend(towers_lst)
@@ -118,116 +165,278 @@ def compute_phonecosts(idir, ofile, days):
     for day in range(1, days + 1):
         daily_lst = [day]
         for tower in towers_lst:
-            lst = users[tower].get(day, list())
+            total, count = users[tower].get(day, (0, 0))
             cost = 0
-            if len(lst) is not 0:
-                cost = sum(lst)/len(lst)
+            if count != 0:
+                cost = total/count
             daily_lst.append(cost)
         rows.append(daily_lst)
     mat = np.array(rows)
-    np.savetxt(ofile, mat)
-
-
-def compute_nationality_feature(idir, odir, nat_ptrs, days):
-    """
-    Generates the counts of each nationality per tower per day
-    :param idir: input user directories
-    :param odir: the output directory
-    :param nat_ptrs: the set of characteristic nationality pointers
-    :param days: the number of days in the month
-    """
-    users = dict()
-    for ifile in get_csv_files(idir):
-        tower = int(ifile.replace('.csv', ''))
-        tdict = defaultdict(list)
-
-        reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
-        for row in reader:
-            day, nat_in = int(row[1]), row[6]
-            nat = nat_ptrs.get(nat_in, None)
-            if nat is not None:
-                tdict[day].append(nat)
+    if binary:
+        save_stack(ofile.replace('.csv', '_'), mat[1:, 1:], mat[1:, 0], towers_lst)
+    else:
+        np.savetxt(ofile, mat)
 
-        users[tower] = tdict
-
-    towers = list(users.keys())
-    nats = list(set(nat_ptrs.values()))
 
+def _write_nationality(users, towers, nats, odir, days, binary=False):
     first_row = [-1]
     first_row.extend([int(i) for i in nats])
 
+    mats = list()
     for day in range(1, days + 1):
         ofile = odir + str(day) + '.csv'
         rows = list()
         rows.append(first_row)
         for tower in towers:
             olst = [int(tower)]
-            counts = Counter(users[tower].get(day, list()))
+            counts = users[tower].get(day, Counter())
             for nat in nats:
                 olst.append(counts.get(nat, 0))
             rows.append(olst)
         omat = np.array(rows)
-        np.savetxt(ofile, omat)
-
-
-def compute_connectivity(idir, odir, tower_ptrs, days):
-    """
-    Computes the connectivity feature
-    :param idir: input directory
-    :param odir: output directory to write to
-    :param tower_ptrs: the set of characteristic tower pointers
-    :param days: the number of days in the month
-    """
-    users = dict()
-    towers, position = dict(), 0
-    for ifile in get_csv_files(idir):
-        tower = int(ifile.replace('.csv', ''))
-        towers[tower] = position # Maps to position in eventual matrix
-        position += 1
-
-        tdict = defaultdict(list)
+        if binary:
+            mats.append(omat[1:, 1:])
+        else:
+            np.savetxt(ofile, omat)
 
-        reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
-        for row in reader:
-            day, t1 = int(row[1]), row[5]
-            ch_tower = tower_ptrs.get(t1, None)
-            if ch_tower is not None:
-                tdict[day].append(ch_tower)
+    if binary:
+        save_stack(odir, np.array(mats).reshape(days, len(towers), len(nats)),
+                   [int(t) for t in towers], first_row[1:])
 
-        users[tower] = tdict
-
-    tower_lst_ps = [(k,v) for k,v in towers.items()]
-    tower_lst_ps.sort(key=lambda x:x[1])
-    towers_lst = [p[0] for p in tower_lst_ps]
 
+def _write_connectivity(users, towers_lst, odir, days, binary=False):
     first_row = [-1]
     first_row.extend([int(i) for i in towers_lst])
 
+    mats = list()
     for day in range(1, days + 1):
         ofile = odir + str(day) + '.csv'
         rows = [first_row]
 
         for tower in towers_lst:
             new_row = [int(tower)]
-            counts = Counter(users[tower].get(day, list()))
+            counts = users[tower].get(day, Counter())
             new_row.extend([counts.get(str(t), 1) if t != tower else 0 for t in towers_lst])
             rows.append(new_row)
         omat = np.array(rows)
-        np.savetxt(ofile, omat)
+        if binary:
+            mats.append(omat[1:, 1:])
+        else:
+            np.savetxt(ofile, omat)
+
+    if binary:
+        save_stack(odir, mats, first_row[1:], first_row[1:])
+
+
+def compute_jaccard_feature(idir, odir, days, num_perm=None, binary=False, store_dir=None):
+    """
+    Computes the jaccard feature for each tower and outputs to numpy matrices
+    :param idir: the input directory of user files
+    :param odir: the output directory
+    :param days: number of days in the month
+    :param num_perm: when set, estimates the dissimilarities from MinHash signatures of this size
+        instead of exact sets. See minhash for the error bounds.
+    :param store_dir: when set, reads the columnar user_store directory instead of the files of idir
+    :outputs: modifies the output directory with daily pairwise distance functions
+    """
+    users = dict()
+    if store_dir is not None:
+        user_ids = None if num_perm is None else load_user_ids(store_dir)
+        towers = _store_towers(store_dir)
+        for tower, recs in towers:
+            tdict = _store_users(recs, user_ids)
+            users[tower] = tdict if num_perm is None else _minhash_days(tdict, num_perm)
+    else:
+        towers = _tower_positions(idir)
+        for tower, ifile in towers:
+            tdict = defaultdict(set)
+
+            reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
+            for row in reader:
+                user, day = row[0], int(row[1])
+                tdict[day].add(user)
+
+            users[tower] = tdict if num_perm is None else _minhash_days(tdict, num_perm)
+
+    _write_jaccard(users, [t for t, _ in towers], odir, days, num_perm, binary)
+
+
+def compute_phonecosts(idir, ofile, days, binary=False, store_dir=None):
+    """
+    Compute the per-tower average phone costs
+    :param idir: the input directory of user data
+    :param ofile: the output file to write to
+    :param days: number of days in the month
+    :param store_dir: when set, reads the columnar user_store directory instead of the files of idir
+    :return: writes the average phone cost in each tower per day.
+        The top row is the list of towers
+    """
+    print(ofile)
+    users = dict()
+    if store_dir is not None:
+        towers = _store_towers(store_dir)
+        for tower, recs in towers:
+            users[tower] = _store_costs(recs)
+    else:
+        towers = _tower_positions(idir)
+        for tower, ifile in towers:
+            tdict = defaultdict(lambda: (0, 0))
+
+            reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
+            for row in reader:
+                day, cost = int(row[1]), int(row[7])
+                total, count = tdict[day]
+                tdict[day] = (total + cost, count + 1)
+
+            users[tower] = tdict
+
+    _write_phonecosts(users, [t for t, _ in towers], ofile, days, binary)
 
 
-def generate_features(odir, references, days_in_month=31):
+def compute_nationality_feature(idir, odir, nat_ptrs, days, binary=False, store_dir=None):
+    """
+    Generates the counts of each nationality per tower per day
+    :param idir: input user directories
+    :param odir: the output directory
+    :param nat_ptrs: the set of characteristic nationality pointers
+    :param days: the number of days in the month
+    :param store_dir: when set, reads the columnar user_store directory instead of the files of idir
+    """
+    users = dict()
+    if store_dir is not None:
+        towers = _store_towers(store_dir)
+        for tower, recs in towers:
+            users[tower] = _store_counts(recs, 'nationality', nat_ptrs)
+    else:
+        towers = _tower_positions(idir)
+        for tower, ifile in towers:
+            tdict = defaultdict(Counter)
+
+            reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
+            for row in reader:
+                day, nat_in = int(row[1]), row[6]
+                nat = nat_ptrs.get(nat_in, None)
+                if nat is not None:
+                    tdict[day][nat] += 1
+
+            users[tower] = tdict
+
+    nats = list(set(nat_ptrs.values()))
+    _write_nationality(users, [t for t, _ in towers], nats, odir, days, binary)
+
+
+def compute_connectivity(idir, odir, tower_ptrs, days, binary=False, store_dir=None):
+    """
+    Computes the connectivity feature
+    :param idir: input directory
+    :param odir: output directory to write to
+    :param tower_ptrs: the set of characteristic tower pointers
+    :param days: the number of days in the month
+    :param store_dir: when set, reads the columnar user_store directory instead of the files of idir
+    """
+    users = dict()
+    if store_dir is not None:
+        towers = _store_towers(store_dir)
+        for tower, recs in towers:
+            users[tower] = _store_counts(recs, 'r_tower', tower_ptrs)
+    else:
+        towers = _tower_positions(idir)
+        for tower, ifile in towers:
+            tdict = defaultdict(Counter)
+
+            reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
+            for row in reader:
+                day, t1 = int(row[1]), row[5]
+                ch_tower = tower_ptrs.get(t1, None)
+                if ch_tower is not None:
+                    tdict[day][ch_tower] += 1
+
+            users[tower] = tdict
+
+    _write_connectivity(users, [t for t, _ in towers], odir, days, binary)
+
+
+def compute_all_features(idir, odirs, references, days, num_perm=None, binary=False, store_dir=None):
+    """
+    Computes the jaccard, phone cost, nationality and connectivity features in a single pass over
+    the user files. The outputs are the same as running the four compute functions separately.
+    :param idir: the input directory of user files
+    :param odirs: an ODirPaths object with the output locations
+    :param references: a ReferencePointers object
+    :param days: number of days in the month
+    :param num_perm: the MinHash signature size for approximate jaccard, None for exact
+    :param binary: when True, writes each feature as a matrix_store stack instead of text files
+    :param store_dir: when set, reads the columns of the user_store directory instead of parsing the
+        files of idir
+    """
+    nat_ptrs, tower_ptrs = references.char_countries, references.char_towers
+    jaccs, costs, nats, conns = dict(), dict(), dict(), dict()
+
+    if store_dir is not None:
+        user_ids = None if num_perm is None else load_user_ids(store_dir)
+        towers = _store_towers(store_dir)
+        for tower, recs in towers:
+            jdict = _store_users(recs, user_ids)
+            if num_perm is not None:
+                jdict = _minhash_days(jdict, num_perm)
+            jaccs[tower], costs[tower] = jdict, _store_costs(recs)
+            nats[tower] = _store_counts(recs, 'nationality', nat_ptrs)
+            conns[tower] = _store_counts(recs, 'r_tower', tower_ptrs)
+    else:
+        towers = _tower_positions(idir)
+        for tower, ifile in towers:
+            jdict, cdict = defaultdict(set), defaultdict(lambda: (0, 0))
+            ndict, tdict = defaultdict(Counter), defaultdict(Counter)
+
+            reader = csv.reader(open(idir + '/' + ifile), delimiter=',')
+            for row in reader:
+                day = int(row[1])
+                jdict[day].add(row[0])
+
+                total, count = cdict[day]
+                cdict[day] = (total + int(row[7]), count + 1)
+
+                nat = nat_ptrs.get(row[6], None)
+                if nat is not None:
+                    ndict[day][nat] += 1
+
+                ch_tower = tower_ptrs.get(row[5], None)
+                if ch_tower is not None:
+                    tdict[day][ch_tower] += 1
+
+            if num_perm is not None:
+                jdict = _minhash_days(jdict, num_perm)
+            jaccs[tower], costs[tower], nats[tower], conns[tower] = jdict, cdict, ndict, tdict
+
+    towers_lst = [t for t, _ in towers]
+    _write_jaccard(jaccs, towers_lst, odirs.jaccs, days, num_perm, binary)
+    _write_phonecosts(costs, towers_lst, odirs.costs, days, binary)
+    _write_nationality(nats, towers_lst, list(set(nat_ptrs.values())), odirs.nats, days, binary)
+    _write_connectivity(conns, towers_lst, odirs.conns, days, binary)
+
+
+def generate_features(odir, references, days_in_month=31, fused=True, num_perm=None, binary=False, store_dir=None):
     """
     Runs the generation of the given features and writes to the given out directory
     :param odir: the out directory currently being used to write to
     :param references: a ReferencePointers object with the reference pointers for the towers and countries
+    :param fused: when True, reads the user files once for all four features
+    :param num_perm: when set, the jaccard feature is approximated with MinHash signatures of this size
+    :param binary: when True, each feature is written as one memory-mappable (days, ...) stack
+        (see matrix_store) instead of one text matrix per day
+    :param store_dir: when set, the user records are read from this user_store directory, e.g. the
+        users_bin directory parse_data_input writes with columnar=True, instead of the user files
     """
     odirs = construct_odir(odir)
 
-    compute_jaccard_feature(odirs.users, odirs.jaccs, days_in_month)
-    compute_phonecosts(odirs.users, odirs.costs, days_in_month)
-    compute_nationality_feature(odirs.users, odirs.nats, references.char_countries, days_in_month)
-    compute_connectivity(odirs.users, odirs.conns, references.char_towers, days_in_month)
+    if fused:
+        compute_all_features(odirs.users, odirs, references, days_in_month, num_perm, binary, store_dir)
+        return
+
+    compute_jaccard_feature(odirs.users, odirs.jaccs, days_in_month, num_perm, binary, store_dir)
+    compute_phonecosts(odirs.users, odirs.costs, days_in_month, binary, store_dir)
+    compute_nationality_feature(odirs.users, odirs.nats, references.char_countries, days_in_month, binary, store_dir)
+    compute_connectivity(odirs.users, odirs.conns, references.char_towers, days_in_month, binary, store_dir)
 
 if __name__ == "__main__":
     odir = './processed_data'
@@ -1,14 +1,21 @@
 import os, csv
+from user_store import get_store_towers, load_tower, load_user_ids
 
 
-def process_data():
+def process_data(store_dir=None):
     dirpath = './processed_data/users/'
     odct = dict()
-    for ifile in os.listdir(dirpath):
-        reader = csv.reader(open(dirpath + ifile), delimiter=',')
-        for row in reader:
-            user, nat, ph_cost = row[0], row[-2], row[-1]
-            odct[user] = (int(nat), int(ph_cost))
+    if store_dir is not None:
+        user_ids = load_user_ids(store_dir)
+        for tower in get_store_towers(store_dir):
+            recs = load_tower(store_dir, tower)
+            odct.update(zip(user_ids[recs['user']], zip(recs['nationality'].tolist(), recs['cost'].tolist())))
+    else:
+        for ifile in os.listdir(dirpath):
+            reader = csv.reader(open(dirpath + ifile), delimiter=',')
+            for row in reader:
+                user, nat, ph_cost = row[0], row[-2], row[-1]
+                odct[user] = (int(nat), int(ph_cost))
 
     ofile = './processed_data/user_nat_ph.csv'
     writer = csv.writer(open(ofile, 'w'), delimiter=',')
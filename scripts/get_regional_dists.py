@@ -1,34 +1,63 @@
+"""
+The loaders read the matrix_store stack written by get_features.generate_features(binary=True) when
+it exists, and the daily text matrices otherwise.
+"""
 import numpy as np
 import os
 
 from itertools import combinations
+from scipy.spatial.distance import cdist
+
+from matrix_store import has_stack, load_stack
+
+PROCESSED_DIR = './processed_data/'
+PHONE_COST_FILE = PROCESSED_DIR + 'phone_cost.csv'
+PHONE_COST_STACK = PROCESSED_DIR + 'phone_cost_'
+JACCARD_DIR = PROCESSED_DIR + 'jaccard/'
+CONNECTIVITY_DIR = PROCESSED_DIR + 'connectivity/'
+NATIONALITY_DIR = PROCESSED_DIR + 'nationality/'
+
+
+def _stack_days(stack):
+    # Stack index 0 is day 1, the first and last days are dropped as for the text files
+    return range(2, stack.shape[0])
 
 
 def _get_phonecost_matrix():
-    fpath = "./processed_data/phone_cost.csv"
-    mat = np.loadtxt(open(fpath))
-    towers = np.array([int(x) for x in mat[0,]][1:])
-    mat = mat[2:, 1:]
-    omats, day = dict(), 2
-    for curr_day in mat:
-        omat = list()
-        for o in curr_day:
-            ilst = list()
-            for i in curr_day:
-                ilst.append(abs(o-i))
-            if np.count_nonzero(np.array(ilst)) > 0:
-                omat.append(np.array(ilst)/np.linalg.norm(np.array(ilst)))
-            else:
-                omat.append(np.array(ilst))
-        omats[day] = np.array(omat)
-        day += 1
-    del omats[31]
+    if has_stack(PHONE_COST_STACK):
+        _, towers, mat = load_stack(PHONE_COST_STACK)
+        towers = np.array([int(x) for x in towers])
+        mat = mat[1:]
+    else:
+        mat = np.loadtxt(open(PHONE_COST_FILE))
+        towers = np.array([int(x) for x in mat[0,]][1:])
+        mat = mat[2:, 1:]
+    dists = _phonecost_distances(mat)
+    # Rows run from day 2 to the last day of the month, the last day is dropped
+    omats = dict((day, dists[i]) for i, day in enumerate(range(2, 1 + len(dists))))
     return towers, omats
 
 
+def _phonecost_distances(mat):
+    """
+    :param mat: a (days, T) array of the average phone cost per tower
+    :return: a (days, T, T) array of |cost_i - cost_j| with every non-zero row scaled to unit norm
+    """
+    dists = np.abs(mat[:, :, None] - mat[:, None, :])
+    norms = np.linalg.norm(dists, axis=2, keepdims=True)
+    return np.divide(dists, norms, out=dists, where=norms > 0)
+
+
 def _get_jaccard():
-    dirpath = './processed_data/jaccard/'
+    dirpath = JACCARD_DIR
     mat_dir = dict()
+    if has_stack(dirpath):
+        _, tower_lst, stack = load_stack(dirpath)
+        tower_lst = np.array([int(x) for x in tower_lst])
+        for day in _stack_days(stack):
+            mat_dir[day] = stack[day - 1]
+        return tower_lst, mat_dir
+
     for ifile in os.listdir(dirpath):
         if ifile == '1.csv' or ifile == '31.csv':
             continue
@@ -41,9 +70,24 @@ def _get_jaccard():
     return tower_lst, mat_dir
 
 
+def _connectivity_distance(mat):
+    olst = list()
+    for lst in mat:
+        olst.append(1 - lst/np.linalg.norm(lst))
+    mat = np.array(olst)
+    np.fill_diagonal(mat, 0)
+    return mat
+
+
 def _get_connectivity():
-    dirpath = './processed_data/connectivity/'
+    dirpath = CONNECTIVITY_DIR
     towers, mat_dir = list(), dict()
+    if has_stack(dirpath):
+        _, tower_lst, stack = load_stack(dirpath)
+        for day in _stack_days(stack):
+            mat_dir[day] = _connectivity_distance(stack[day - 1])
+        return np.array([int(x) for x in tower_lst]), mat_dir
+
     for ifile in os.listdir(dirpath):
         if ifile == '1.csv' or ifile == '31.csv':
             continue
@@ -52,28 +96,56 @@ def _get_connectivity():
         tower_lst = np.array([int(x) for x in mat[0,]][1:])
         mat = mat[1:, 1:]
         towers.append(tower_lst)
-        olst = list()
-        for lst in mat:
-            olst.append(1 - lst/np.linalg.norm(lst))
-        mat = np.array(olst)
-        np.fill_diagonal(mat, 0)
-        mat_dir[day] = mat
+        mat_dir[day] = _connectivity_distance(mat)
     return towers[0], mat_dir
 
 
-def _get_tow_array(mat, tower, towers):
-    if tower in towers:
-        idx = towers.index(tower)
-        return mat[idx,]
-    else:
-        return np.array([0]*192)
+def _align_nationality(mat, towers, nat_towers):
+    """
+    Reorders the nationality counts to the tower header
+    :param mat: a (..., len(nat_towers), N) array of nationality counts
+    :param towers: the tower header to align to
+    :param nat_towers: the towers of the rows of mat
+    :return: a (..., len(towers), N) array, towers without counts get a zero row
+    """
+    nat_index = dict((t, i) for i, t in enumerate(nat_towers))
+    rows = np.array([nat_index.get(t, -1) for t in towers], dtype=int)
+    aligned = np.zeros(mat.shape[:-2] + (len(towers), mat.shape[-1]))
+    present = rows >= 0
+    aligned[..., present, :] = mat[..., rows[present], :]
+    return aligned
+
+
+def _nationality_distances(aligned):
+    """
+    :param aligned: a (days, T, N) array from _align_nationality
+    :return: a (days, T, T) array of euclidean distances between tower rows, each non-zero row
+        scaled to unit norm, zero off-diagonal entries set to 1 and a zero diagonal
+    """
+    dists = np.array([cdist(day_mat, day_mat) for day_mat in aligned]).reshape(
+        aligned.shape[0], aligned.shape[1], aligned.shape[1])
+    norms = np.linalg.norm(dists, axis=2, keepdims=True)
+    dists = np.divide(dists, norms, out=dists, where=norms > 0)
+    dists[dists == 0] = 1
+    diag = np.arange(dists.shape[1])
+    dists[:, diag, diag] = 0
+    return dists
 
 
 def _get_nationality(towers):
-    dirpath = './processed_data/nationality/'
+    dirpath = NATIONALITY_DIR
     mat_dir = dict()
     nats = list()
     nat_towers= list()
+    if has_stack(dirpath):
+        nat_towers, nats, stack = load_stack(dirpath)
+        days = _stack_days(stack)
+        aligned = _align_nationality(stack[days.start - 1:days.stop - 1], towers, [int(x) for x in nat_towers])
+        dists = _nationality_distances(aligned)
+        for i, day in enumerate(days):
+            mat_dir[day] = dists[i]
+        return np.array([int(x) for x in nats]), mat_dir
+
     for ifile in os.listdir(dirpath):
         if ifile == '1.csv' or ifile == '31.csv':
             continue
@@ -82,23 +154,8 @@ def _get_nationality(towers):
         nats = np.array([int(x) for x in mat[0,]][1:])
         nat_towers = [int(x) for x in mat[:,0]][1:]
 
-        mat = mat[1:,1:]
-        olst = list()
-        for t1 in towers:
-            ilst = list()
-            t1_arr = _get_tow_array(mat, t1, nat_towers)
-            for t2 in towers:
-                t2_arr = _get_tow_array(mat, t2, nat_towers)
-                ilst.append(np.linalg.norm(t1_arr-t2_arr))
-            arr = np.array(ilst)
-            if np.count_nonzero(arr)>0:
-                olst.append(arr/np.linalg.norm(arr))
-            else:
-                olst.append(arr)
-        mat = np.array(olst)
-        mat[mat==0] = 1
-        np.fill_diagonal(mat, 0)
-        mat_dir[day] = mat
+        aligned = _align_nationality(mat[None, 1:, 1:], towers, nat_towers)
+        mat_dir[day] = _nationality_distances(aligned)[0]
 
     return nats, mat_dir
 
@@ -0,0 +1,111 @@
+"""
+A flat clustering as sorted tower ids and an integer cluster label per tower. Iterating it yields the
+clusters as lists of towers. On disk it is a CSV with one cluster per row, or an .npz of the towers
+and labels arrays.
+"""
+import csv, os
+import numpy as np
+
+
+class LabelClustering:
+
+    def __init__(self, towers, labels):
+        order = np.argsort(towers, kind='stable')
+        self.towers = np.asarray(towers, dtype=int)[order]
+        self.labels = np.asarray(labels, dtype=int)[order]
+        self.tower_pos = dict((t, i) for i, t in enumerate(self.towers.tolist()))
+        self._members = None
+
+    @classmethod
+    def from_lists(cls, clustering):
+        """
+        :param clustering: a list of clusters, each a list of towers
+        """
+        towers = [int(t) for cl in clustering for t in cl]
+        labels = [label for label, cl in enumerate(clustering) for _ in cl]
+        return cls(towers, labels)
+
+    @property
+    def n_clusters(self):
+        return int(self.labels.max()) + 1 if len(self.labels) else 0
+
+    def _groups(self):
+        if self._members is None:
+            order = np.argsort(self.labels, kind='stable')
+            bounds = np.cumsum(np.bincount(self.labels, minlength=self.n_clusters))[:-1]
+            self._members = np.split(self.towers[order], bounds)
+        return self._members
+
+    def cluster_of(self, tower):
+        """
+        :return: the label of the tower's cluster, or None if the tower is not clustered
+        """
+        pos = self.tower_pos.get(tower, None)
+        return None if pos is None else int(self.labels[pos])
+
+    def members(self, label):
+        return self._groups()[label]
+
+    def cluster_members(self, tower):
+        """
+        :return: the set of towers sharing a cluster with the given tower (itself included),
+            or None if the tower is not clustered
+        """
+        label = self.cluster_of(tower)
+        return None if label is None else set(self.members(label).tolist())
+
+    def align(self, towers):
+        """
+        :param towers: a sequence of tower ids
+        :return: a label per given tower. Towers not in this clustering each get a new label of their own.
+        """
+        labels = np.empty(len(towers), dtype=int)
+        extra = self.n_clusters
+        for i, t in enumerate(towers):
+            pos = self.tower_pos.get(t, None)
+            if pos is None:
+                labels[i] = extra
+                extra += 1
+            else:
+                labels[i] = self.labels[pos]
+        return labels
+
+    def to_lists(self):
+        return [m.tolist() for m in self._groups()]
+
+    def __iter__(self):
+        return iter(self.to_lists())
+
+    def __len__(self):
+        return self.n_clusters
+
+    def save(self, fpath):
+        np.savez(fpath, towers=self.towers, labels=self.labels)
+
+    @classmethod
+    def load(cls, fpath):
+        arrays = np.load(fpath)
+        return cls(arrays['towers'], arrays['labels'])
+
+
+def read_clustering(ifile):
+    """
+    Reads a clustering from a .csv (one cluster per row) or a .npz file
+    """
+    if ifile.endswith('.npz'):
+        return LabelClustering.load(ifile)
+    reader = csv.reader(open(ifile), delimiter=',')
+    return LabelClustering.from_lists([[int(t) for t in row] for row in reader])
+
+
+def read_clustering_dir(cdir):
+    """
+    :param cdir: a directory of <day>.csv or <day>.npz clusterings, the .npz is used when both exist
+    :return: a day -> LabelClustering dictionary
+    """
+    files = dict()
+    for ifile in sorted(os.listdir(cdir), key=lambda f: f.endswith('.npz')):
+        stem, ext = os.path.splitext(ifile)
+        if ext in ('.csv', '.npz'):
+            files[int(stem)] = ifile
+    return dict((day, read_clustering(os.path.join(cdir, ifile))) for day, ifile in files.items())
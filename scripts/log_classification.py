@@ -1,15 +1,16 @@
 import numpy as np
+import sys
 import time
 from functools import partial
 import heapq
 from collections import Counter
 import multiprocessing as mp
 from operator import itemgetter
-from math import ceil
 from random import shuffle
 
 from markov_model_priors import generate_priors, generate_transition_matrix
 from cspa_clustering import get_clustering
+from shared_arrays import share_array, attach_array, release
 
 
 def path_generator(day_paths):
@@ -21,10 +22,10 @@ def path_generator(day_paths):
                 yield o1, o2, prior, nxt
 
 
-def get_xy(paths, tower_pos, o1_tt_pos, o2_tt_pos, o1_curr_mat, o2_curr_mat, le_curr_mat, co_curr_mat):
+def get_xy(paths, tower_pos, o1_curr_mat, o2_curr_mat, le_curr_mat, co_curr_mat):
     for o1, o2, curr, nxt in path_generator(paths):
-        o1_prior = o1_curr_mat[o1_tt_pos[o1]]
-        o2_prior = o2_curr_mat[o2_tt_pos[o2]]
+        o1_prior = o1_curr_mat[o1]
+        o2_prior = o2_curr_mat[o2]
 
         le_prior = le_curr_mat[tower_pos[curr]]
         co_prior = co_curr_mat[tower_pos[curr]]
@@ -62,24 +63,126 @@ def knn_worker(test_paths, ref_paths, generator_partial, k=30):
     return matches, total
 
 
-def do_logregress():
+def feature_matrix(paths, generator_partial):
+    """
+    Materializes the get_xy features of the paths once
+    :return: a contiguous (transitions, features) float32 matrix and the array of next stops
+    """
+    rows, nexts = list(), list()
+    for row, nxt in generator_partial(paths=paths):
+        rows.append(row)
+        nexts.append(nxt)
+    width = len(rows[0]) if rows else 0
+    return np.array(rows, dtype=np.float32).reshape(len(rows), width), np.array(nexts)
+
+
+class KNNClassifier:
+    """
+    Brute-force k nearest neighbours over a precomputed float32 reference matrix. Distances to a
+    block of queries come from one matrix product, |q|^2 - 2 q.r + |r|^2, so the work runs in BLAS.
+    Rows at equal distance are ranked by decreasing next stop, so the k rows kept are the ones the
+    heap in knn_worker keeps when it is given k-1. The prediction is the most common next stop among
+    them, ties going to the stop of the nearest tied row. knn_worker breaks such ties by the order
+    of its heap array instead, so the two can disagree when two stops get the same number of votes.
+    """
+
+    def __init__(self, features, labels, k=30, memory_budget=2**28):
+        """
+        :param memory_budget: the bytes a block of queries may take. Each query costs about 13 bytes
+            per reference row, the float32 distances, the int64 argpartition and the bool tie mask.
+        """
+        self.features = np.ascontiguousarray(features, dtype=np.float32)
+        self.sq_norms = np.einsum('ij,ij->i', self.features, self.features)
+        self.classes, self.label_idx = np.unique(labels, return_inverse=True)
+        self.k = min(k, len(self.features))
+        self.block_size = max(1, memory_budget // (max(1, len(self.features)) * 13))
+
+    def kneighbors(self, queries):
+        """
+        :return: a (queries, k) array of reference row indices, nearest first
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        out = np.empty((len(queries), self.k), dtype=int)
+        for start in range(0, len(queries), self.block_size):
+            block = queries[start:start + self.block_size]
+            dists = self.sq_norms[None, :] - 2*block.dot(self.features.T) + np.einsum('ij,ij->i', block, block)[:, None]
+            nearest = np.argpartition(dists, self.k - 1, axis=1)[:, :self.k]
+            kth = np.take_along_axis(dists, nearest, axis=1).max(axis=1)
+            for i in np.flatnonzero((dists <= kth[:, None]).sum(axis=1) > self.k):
+                # more rows than k at the k-th distance, keep the ones with the larger next stop
+                cand = np.flatnonzero(dists[i] <= kth[i])
+                nearest[i] = cand[np.lexsort((-self.label_idx[cand], dists[i, cand]))[:self.k]]
+            order = np.lexsort((-self.label_idx[nearest], np.take_along_axis(dists, nearest, axis=1)), axis=-1)
+            out[start:start + len(block)] = np.take_along_axis(nearest, order, axis=1)
+        return out
+
+    def predict(self, queries):
+        labels = self.label_idx[self.kneighbors(queries)]
+        n_classes = len(self.classes)
+        rows = np.arange(len(labels))[:, None]
+        counts = np.bincount((rows*n_classes + labels).ravel(), minlength=len(labels)*n_classes).reshape(len(labels), n_classes)
+        tied = counts[rows, labels] == counts.max(axis=1)[:, None]
+        return self.classes[labels[rows[:, 0], tied.argmax(axis=1)]]
+
+
+def knn_classify_worker(test_paths, classifier, generator_partial):
+    test_features, test_next = feature_matrix(test_paths, generator_partial)
+    if len(test_next) == 0:
+        return 0, 0
+    return int((classifier.predict(test_features) == test_next).sum()), len(test_next)
+
+
+_classifier = None
+
+
+def _init_knn_worker(ref_spec, next_spec, k):
+    global _classifier
+    _classifier = KNNClassifier(attach_array(ref_spec), attach_array(next_spec), k=k)
+
+
+def _knn_shared_chunk(test_spec, next_spec, start, end):
+    """
+    Classifies rows start:end of the shared test features with the worker's classifier
+    """
+    test_features, test_next = attach_array(test_spec)[start:end], attach_array(next_spec)[start:end]
+    return int((_classifier.predict(test_features) == test_next).sum()), len(test_next)
+
+
+def benchmark_knn(test_paths, ref_paths, generator_partial, k=30):
+    """
+    Times knn_worker against KNNClassifier on the same test paths. The heap in knn_worker keeps k+1
+    rows, so the classifier is given k+1 neighbours to answer the same question.
+    :return: (brute force seconds, classifier build seconds, classifier query seconds,
+        brute force accuracy, classifier accuracy)
+    """
+    istart = time.time()
+    old_matches, old_total = knn_worker(test_paths, ref_paths, generator_partial, k=k)
+    old_secs = time.time() - istart
+
+    istart = time.time()
+    ref_features, ref_next = feature_matrix(ref_paths, generator_partial)
+    classifier = KNNClassifier(ref_features, ref_next, k=k+1)
+    build_secs = time.time() - istart
+
+    istart = time.time()
+    new_matches, new_total = knn_classify_worker(test_paths, classifier, generator_partial)
+    query_secs = time.time() - istart
+    return old_secs, build_secs, query_secs, old_matches/old_total, new_matches/new_total
+
+
+def knn_inputs():
+    """
+    :return: the day 22 test paths, the day 2 to 21 reference paths and the get_xy partial that
+        featurizes them with the day 21 priors and clusterings
+    """
     cspa_towers, learned_clusts, consensus_clusts, combined_clusts = get_clustering()
-    upaths, _, o1_priors_mats, markov_towers, o1_tower_tuples = generate_priors()
-    o2_priors_mats, o2_tower_tuples = generate_transition_matrix(upaths, markov_towers, order=2)
+    upaths, _, o1_priors_mats, markov_towers, _ = generate_priors()
+    o2_priors_mats, _ = generate_transition_matrix(upaths, markov_towers, order=2)
 
     tower_pos = dict()
     for i, tow in enumerate(cspa_towers):
         tower_pos[tow] = i
 
-    o1_tt_pos = dict()
-    for i, ttup in enumerate(o1_tower_tuples):
-        o1_tt_pos[ttup] = i
-
-    o2_tt_pos = dict()
-    for i, ttup in enumerate(o2_tower_tuples):
-        o2_tt_pos[ttup] = i
-
-    dlength = len(upaths[22])
     print("Need to test paths: ", len(upaths[22]))
 
     o1_curr_mat = o1_priors_mats[21]
@@ -89,24 +192,52 @@ def do_logregress():
 
     paths = [path for day in range(2, 22) for path in upaths[day]]
 
-    info_gen_part = partial(get_xy, tower_pos=tower_pos, o1_tt_pos=o1_tt_pos, o2_tt_pos=o2_tt_pos,
-                            o1_curr_mat=o1_curr_mat, o2_curr_mat=o2_curr_mat, le_curr_mat=le_curr_mat,
-                            co_curr_mat =co_curr_mat)
+    info_gen_part = partial(get_xy, tower_pos=tower_pos, o1_curr_mat=o1_curr_mat, o2_curr_mat=o2_curr_mat,
+                            le_curr_mat=le_curr_mat, co_curr_mat =co_curr_mat)
+    return upaths[22], paths, info_gen_part
 
-    p = mp.Pool(processes=6)
-    chunks = ceil(dlength/6)*6
-    knn_partial = partial(knn_worker, ref_paths=paths, generator_partial=info_gen_part, k=30)
-    print("Starting call to knn worker")
-    istart = time.time()
-    #knn_partial(upaths[22])
-    results = [p.apply_async(knn_partial, args=(ipath,)) for ipath in splitter_generator(upaths[22][:140], 25)]
-    matched = [r.get() for r in results]
+
+def do_benchmark(n_test=140):
+    test_paths, paths, info_gen_part = knn_inputs()
+    old_secs, build_secs, query_secs, old_acc, new_acc = benchmark_knn(test_paths[:n_test], paths, info_gen_part)
+    print("Brute force: ", old_secs, "accuracy: ", old_acc)
+    print("Classifier build: ", build_secs, "query: ", query_secs, "accuracy: ", new_acc)
+
+
+def do_logregress():
+    test_paths, paths, info_gen_part = knn_inputs()
+
+    # Features are built once here. Workers attach to the shared feature matrices, so neither the
+    # priors nor the reference rows are pickled per task or copied per worker.
+    ref_features, ref_next = feature_matrix(paths, info_gen_part)
+    test_features, test_next = feature_matrix(test_paths[:140], info_gen_part)
+    blocks = list()
+    try:
+        for arr in (ref_features, ref_next, test_features, test_next):
+            blocks.append(share_array(arr))
+        ref_spec, ref_next_spec, test_spec, test_next_spec = [spec for _, spec in blocks]
+
+        # knn_worker's heap keeps k+1 = 31 rows, keep the same neighbourhood
+        with mp.Pool(processes=6, initializer=_init_knn_worker, initargs=(ref_spec, ref_next_spec, 31)) as p:
+            print("Starting call to knn worker")
+            istart = time.time()
+            results = [p.apply_async(_knn_shared_chunk, args=(test_spec, test_next_spec, r.start, r.stop))
+                       for r in splitter_generator(range(len(test_next)), 64)]
+            matched = [r.get() for r in results]
+    finally:
+        # the pool has shut its workers down by now, so nothing is still attached
+        for shm, _ in blocks:
+            release(shm)
     mtch, total = sum(i[0] for i in matched), sum(i[1] for i in matched)
     print("Accuracy was: ", mtch/total, total)
     print("Completed working for one, time: ", time.time()-istart)
 
 
 if __name__ == "__main__":
-    do_logregress()
+    # python log_classification.py benchmark [n_test] times the classifier against knn_worker instead
+    if sys.argv[1:2] == ['benchmark']:
+        do_benchmark(*[int(a) for a in sys.argv[2:3]])
+    else:
+        do_logregress()
 
 
@@ -1,3 +1,6 @@
+import numpy as np
+import multiprocessing as mp
+import time
 from markov_model_priors import *
 from functools import partial
 from math import sqrt
@@ -20,64 +23,182 @@ def compute_path_prob(path, position_mat, tpos_mat):
 """
 
 
-def compute_transition_precision(day_range, order, tower_tuples, trans_mat, user_paths, pos_mat, towers):
+def transition_arrays(day_paths, order, tpos_dct):
+    """
+    :return: the distinct contexts of the day's transitions, and for every transition the index of its
+        context in that list and the position of its destination tower
+    """
+    contexts, ctx_idx, dests = dict(), list(), list()
+    for p in day_paths:
+        for ipath, dest in generate_transitions(p, order):
+            tpos = tpos_dct.get(dest, None)
+            if tpos is not None and all(t in tpos_dct for t in ipath):
+                ctx_idx.append(contexts.setdefault(ipath, len(contexts)))
+                dests.append(tpos)
+    return list(contexts), np.array(ctx_idx, dtype=int), np.array(dests, dtype=int)
+
+
+def destination_ranks(trans, contexts, ctx_idx, dests):
+    """
+    :param trans: the SparseTransitions of a day
+    :return: the rank of each destination in its context's row, 0 for the row's argmax. Ties go to
+        the tower with the lower position, so rank 0 is what trans.index(max(trans)) would pick.
+    """
+    rows = trans.dense_rows(contexts)
+    order = np.argsort(-rows, axis=1, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(rows.shape[1]), order.shape), axis=1)
+    return ranks[ctx_idx, dests]
+
+
+def evaluate_transitions(day_range, order, trans_mat, user_paths, towers, k=5):
+    """
+    Scores the paths of the day before each day against the model of that day
+    :return: a list of (day, top-1 mean, top-1 std, top-k mean, transitions) tuples
+    """
     tpos_dct = dict()
     for i, tow in enumerate(towers):
         tpos_dct[tow] = i
 
     day_results = list()
     for day in day_range:
-        u_paths = user_paths.get(day-1, None)
-        u_pos = pos_mat[day-3]
-        u_transmat = trans_mat.get(day-1, None)
-
-        ttupos_dct = dict()
-        for i, ttups in enumerate(tower_tuples):
-            ttupos_dct[ttups] = i
-
-        out = list()
-        for p in u_paths:
-            for ipath, dest in generate_transitions(p, order):
-                ttup_pos = ttupos_dct.get(ipath, None)
-                if ttup_pos is not None:
-                    trans = list(u_transmat[ttup_pos]) # u_transmat[ttup_pos]
-                    tpos = tpos_dct.get(dest, None)
-                    if tpos is not None:
-                        idx = trans.index(max(trans))
-                        if idx == tpos:
-                            out.append(1)
-                        else:
-                            out.append(0)
-                        #out.append(trans[tpos])
-        m, std = mn_std(out)
-        day_results.append((day, m, std))
+        contexts, ctx_idx, dests = transition_arrays(user_paths.get(day-1, list()), order, tpos_dct)
+        ranks = destination_ranks(trans_mat[day-1], contexts, ctx_idx, dests)
+        top1 = ranks == 0
+        day_results.append((day, float(top1.mean()), float(top1.std()), float((ranks < k).mean()), len(ranks)))
+    return day_results
+
+
+def compute_transition_precision(day_range, order, trans_mat, user_paths, pos_mat, towers, k=5):
+    """
+    :return: a list of (day, top-1 mean, top-1 std, top-k mean, k) tuples
+    """
+    day_results = [(day, m, std, topk, k)
+                   for day, m, std, topk, _ in evaluate_transitions(day_range, order, trans_mat, user_paths, towers, k)]
     print("Completed computation for order: ", order)
     return day_results
 
 
 
 
-def run_markov_model(max_order=5, all_orders=True):
+def run_markov_model(max_order=5, all_orders=True, k=5):
     if not all_orders or max_order == 1:
          user_paths, pos_matrix, transition_matrices, towers, tower_tuples = generate_priors(max_order)
-         res = compute_transition_precision(range(20, 31), max_order, tower_tuples, transition_matrices, user_paths, pos_matrix, towers)
+         res = compute_transition_precision(range(20, 31), max_order, transition_matrices, user_paths, pos_matrix, towers, k)
          print(res)
     else:
         user_paths, pos_matrix, transition_matrices, towers, tower_tuples = generate_priors(1)
 
-        part_compute = partial(compute_transition_precision, user_paths=user_paths, pos_mat=pos_matrix, towers=towers)
+        part_compute = partial(compute_transition_precision, user_paths=user_paths, pos_mat=pos_matrix, towers=towers, k=k)
 
-        ordered_trans_mats = [(1, transition_matrices, tower_tuples)]
+        ordered_trans_mats = [(1, transition_matrices)]
         for order in range(2, max_order + 1):
-            omats, ttups = generate_transition_matrix(user_paths, towers, order=order)
-            ordered_trans_mats.append((order, omats, ttups))
+            omats, _ = generate_transition_matrix(user_paths, towers, order=order)
+            ordered_trans_mats.append((order, omats))
             print("Computed priors for ", order)
 
-        results = [part_compute(range(20, 31), o, tt, trans) for o, trans, tt in ordered_trans_mats]
+        results = [part_compute(range(20, 31), o, trans) for o, trans in ordered_trans_mats]
         writer = csv.writer(open("./processed_data/mmperf_ord5_r20_30.csv", 'w'), delimiter=',')
         writer.writerows(results)
 
 
+# The parallel runner hands its inputs to the workers through the pool initializer. With the fork
+# start method they are inherited copy-on-write, never pickled. A forked worker starts with the
+# parent's pages already resident, so its RSS says nothing about a task; each task reports the peak
+# RSS it added on top of what its worker held when the task started.
+_shared = None
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def _task_memory_start():
+    """
+    Resets the process's peak RSS to its current RSS where Linux allows it
+    :return: the current RSS in kB, or None where /proc/self is not available
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return _status_kb('VmRSS')
+    except (IOError, OSError):
+        return None
+
+
+def _task_peak_mb(start_kb):
+    """
+    :return: the peak RSS reached since _task_memory_start minus the RSS at that time, in MB
+    """
+    if start_kb is None:
+        return float('nan')
+    return max(_status_kb('VmHWM') - start_kb, 0)/1024.0
+
+
+def _count_order(order):
+    istart, start_kb = time.time(), _task_memory_start()
+    contexts, _, day_mats = count_transitions(_shared['user_paths'], _shared['towers'], order)
+    return contexts, day_mats, time.time() - istart, _task_peak_mb(start_kb)
+
+
+def _score_order_day(order, day, k):
+    istart, start_kb = time.time(), _task_memory_start()
+    contexts, day_mats = _shared['counts'][order]
+    snapshots = transition_snapshots(dict((c, i) for i, c in enumerate(contexts)), day_mats)
+    res = evaluate_transitions([day], order, snapshots, _shared['user_paths'], _shared['towers'], k)[0]
+    return res, time.time() - istart, _task_peak_mb(start_kb)
+
+
+def run_markov_model_parallel(max_order=5, processes=None, day_range=range(20, 31), maxtasksperchild=1, k=5):
+    """
+    Counts the transitions of every order, then scores every (order, day) pair, on process pools.
+    Writes the same precision file as run_markov_model and a _perf.csv next to it with, per order,
+    the seconds spent counting and scoring (summed over tasks) and the largest memory any of its
+    tasks added on top of its worker's starting RSS, in MB (Linux only, nan elsewhere).
+    :param k: the rank cutoff of the top-k mean written next to the top-1 mean and std of each day
+    """
+    towers = get_towers()
+    user_paths = get_paths_byday()
+    orders = list(range(1, max_order + 1))
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+
+    shared = {'user_paths': user_paths, 'towers': towers}
+    with ctx.Pool(processes=processes, initializer=_init_worker, initargs=(shared,),
+                  maxtasksperchild=maxtasksperchild) as p:
+        counted = dict(zip(orders, p.map(_count_order, orders, chunksize=1)))
+
+    shared['counts'] = dict((order, res[:2]) for order, res in counted.items())
+    with ctx.Pool(processes=processes, initializer=_init_worker, initargs=(shared,),
+                  maxtasksperchild=maxtasksperchild) as p:
+        tasks = [(order, p.apply_async(_score_order_day, args=(order, day, k))) for order in orders for day in day_range]
+        scored = [(order, r.get()) for order, r in tasks]
+
+    results, perf = list(), list()
+    for order in orders:
+        order_scored = [res for o, res in scored if o == order]
+        results.append([(day, m, std, topk, k) for (day, m, std, topk, _), _, _ in order_scored])
+        perf.append((order, counted[order][2], sum(secs for _, secs, _ in order_scored),
+                     max([counted[order][3]] + [rss for _, _, rss in order_scored])))
+        print("Completed computation for order: ", order)
+
+    writer = csv.writer(open("./processed_data/mmperf_ord5_r20_30.csv", 'w'), delimiter=',')
+    writer.writerows(results)
+
+    writer = csv.writer(open("./processed_data/mmperf_ord5_r20_30_perf.csv", 'w'), delimiter=',')
+    writer.writerow(['order', 'count_secs', 'score_secs', 'task_peak_mb'])
+    writer.writerows(perf)
+    return results, perf
+
+
 
 if __name__ == "__main__":
-    run_markov_model(max_order=3, all_orders=True)
\ No newline at end of file
+    run_markov_model(max_order=3, all_orders=True)
+    # run_markov_model_parallel(max_order=5)
\ No newline at end of file
@@ -1,8 +1,15 @@
+"""
+Transition matrices are sparse, with a row per observed context (a tuple of order towers), so memory
+scales with the transitions in the paths rather than with T^order. Unobserved contexts read as zero rows.
+"""
 import numpy as np
 import csv
-from itertools import product
 from collections import defaultdict
+from functools import partial
 from operator import itemgetter
+from scipy.sparse import csr_matrix
+
+from snapshots import CumulativeSnapshots
 
 
 def time_difference(t1, t2):
@@ -69,38 +76,112 @@ def generate_transitions(path, wlength):
             yield tuple(ipath), res
 
 
-def generate_transition_matrix(paths, towers, order):
+def normalize_csr_rows(mat):
+    """
+    Sparse version of normalize_mat_rows, returns a new matrix
+    """
+    mat = csr_matrix(mat, dtype=float, copy=True)
+    norms = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    mat.data *= np.repeat(scale, np.diff(mat.indptr))
+    return mat
+
+
+class SparseTransitions:
+    """
+    One day's transition probabilities
+    :param mat: a (contexts, towers) csr_matrix
+    :param context_pos: a context -> row dictionary shared by every day of a model
+    """
+
+    def __init__(self, mat, context_pos):
+        self.matrix = mat
+        self.context_pos = context_pos
+
+    def __getitem__(self, context):
+        """
+        :return: the dense probability row of the context, zeros if it was never observed
+        """
+        row = self.context_pos.get(context, None)
+        if row is None:
+            return np.zeros(self.matrix.shape[1])
+        return self.matrix.getrow(row).toarray().ravel()
+
+    def __contains__(self, context):
+        return context in self.context_pos
+
+    def dense_rows(self, contexts):
+        """
+        :return: a (len(contexts), towers) array of the contexts' rows, zeros for contexts never observed
+        """
+        pos = np.array([self.context_pos.get(c, -1) for c in contexts], dtype=int)
+        rows = np.zeros((len(contexts), self.matrix.shape[1]))
+        seen = pos >= 0
+        if seen.any():
+            rows[seen] = self.matrix[pos[seen]].toarray()
+        return rows
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+
+def count_transitions(paths, towers, order):
+    """
+    :return: the sorted observed contexts, a context -> row dictionary and a day -> (contexts, towers)
+        csr_matrix of transition counts for days 2-30
+    """
     tpos = dict()
     for i, tower in enumerate(towers):
         tpos[tower] = i
-    tower_tuples = [combo for combo in product(towers, repeat=order)]
-    ttuple_pos = dict()
-    for i, tuple in enumerate(tower_tuples):
-        ttuple_pos[tuple] = i
+
+    day_counts = dict()
+    for day, day_paths in paths.items():
+        if 2 <= day <= 30:
+            counts = day_counts.setdefault(day, defaultdict(int))
+            for p in day_paths:
+                for ipath, result in generate_transitions(p, order):
+                    if result in tpos and all(t in tpos for t in ipath):
+                        counts[(ipath, tpos[result])] += 1
+
+    contexts = sorted(set(ipath for counts in day_counts.values() for ipath, _ in counts))
+    context_pos = dict((c, i) for i, c in enumerate(contexts))
 
     day_mats = dict()
-    for i in range(2, 31):
-        day_mats[i] = np.zeros((len(tower_tuples), len(towers)))
+    for day in range(2, 31):
+        counts = day_counts.get(day, dict())
+        rows = [context_pos[ipath] for ipath, _ in counts]
+        cols = [col for _, col in counts]
+        day_mats[day] = csr_matrix((list(counts.values()), (rows, cols)), shape=(len(contexts), len(towers)), dtype=float)
+    return contexts, context_pos, day_mats
 
-    for day, day_paths in paths.items():
-        for p in day_paths:
-            for ipath, result in generate_transitions(p, order):
-                row, column = ttuple_pos.get(ipath, None), tpos.get(result, None)
-                if row is not None and column is not None:
-                    day_mats[day][row,column] += 1
 
-    omats = dict()
-    curr_omat = day_mats[2]
-    omats[2] = normalize_mat_rows(curr_omat)
+def _transition_snapshot(counts, context_pos):
+    return SparseTransitions(normalize_csr_rows(counts), context_pos)
 
-    for i in range(3, 31):
-        curr_omat += day_mats[i]
-        omats[i] = normalize_mat_rows(curr_omat)
 
-    return omats, tower_tuples
+def transition_snapshots(context_pos, day_mats):
+    """
+    :param context_pos, day_mats: as returned by count_transitions
+    :return: CumulativeSnapshots of the row-normalized transitions up to each day
+    """
+    return CumulativeSnapshots(day_mats, partial(_transition_snapshot, context_pos=context_pos))
+
+
+def generate_transition_matrix(paths, towers, order):
+    """
+    :return: CumulativeSnapshots mapping a day to the SparseTransitions of the row-normalized
+        transition counts of the days up to and including that day, and the list of observed contexts
+    """
+    contexts, context_pos, day_mats = count_transitions(paths, towers, order)
+    return transition_snapshots(context_pos, day_mats), contexts
 
 
 def generate_probability_matrices(paths, towers):
+    """
+    :return: CumulativeSnapshots mapping a day (2-30) to the normalized tower visit counts of the
+        days up to and including that day
+    """
     tower_pos = dict()
     for i, t in enumerate(towers):
         tower_pos[t] = i
@@ -114,21 +195,17 @@ def generate_probability_matrices(paths, towers):
                 if tpos is not None:
                     pos_mat[cday, tpos] += 1
 
-    olst = list()
-    curr_sum = pos_mat[0]
-    olst.append(normalize_prob_row(curr_sum))
+    return CumulativeSnapshots(dict((cday + 2, row) for cday, row in enumerate(pos_mat)), normalize_prob_row)
 
-    for row in pos_mat[1:]:
-        curr_sum += row
-        olst.append(normalize_prob_row(curr_sum))
 
-    return olst
+def get_towers():
+    treader = csv.reader(open("./processed_data/char_towers_only.csv"), delimiter=',')
+    towers = sorted([row for row in treader][0])
+    return list(map(int, towers))
 
 
 def generate_priors(order=1):
-    treader = csv.reader(open("./processed_data/char_towers_only.csv"), delimiter=',')
-    towers = sorted([row for row in treader][0])
-    towers = list(map(int, towers))
+    towers = get_towers()
 
     paths = get_paths_byday()
     mats, tower_tuples = generate_transition_matrix(paths, towers, order=order)
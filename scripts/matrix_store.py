@@ -0,0 +1,30 @@
+"""
+Binary container for a feature's daily matrices, written as three .npy files sharing a prefix:
+        -- <prefix>stack.npy: the (days, ...) array, index 0 is day 1
+        -- <prefix>rows.npy: the header of the second axis (towers)
+        -- <prefix>cols.npy: the header of the last axis (towers or nationalities)
+The stack is memory-mapped on load.
+"""
+import os
+import numpy as np
+
+
+def save_stack(prefix, stack, rows, cols):
+    np.save(prefix + 'stack.npy', np.asarray(stack, dtype=float))
+    np.save(prefix + 'rows.npy', np.asarray(rows))
+    np.save(prefix + 'cols.npy', np.asarray(cols))
+
+
+def has_stack(prefix):
+    return os.path.exists(prefix + 'stack.npy')
+
+
+def load_stack(prefix, mmap_mode='c'):
+    """
+    :param prefix: the prefix the stack was saved with
+    :param mmap_mode: the np.load memory-map mode. The default copy-on-write mode gives writable
+        arrays whose changes are never written back to the file.
+    :return: rows, cols, stack
+    """
+    stack = np.load(prefix + 'stack.npy', mmap_mode=mmap_mode)
+    return np.load(prefix + 'rows.npy'), np.load(prefix + 'cols.npy'), stack
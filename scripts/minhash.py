@@ -0,0 +1,79 @@
+"""
+MinHash signatures for approximate Jaccard dissimilarities.
+
+Position k of a signature is the minimum over the set of a seeded 64-bit hash, splitmix64(x XOR seed_k).
+Two signatures agree at a position with probability J, the Jaccard similarity, so the fraction of agreeing
+positions estimates J with standard deviation sqrt(J(1-J)/num_perm). By Hoeffding's inequality the error
+exceeds eps with probability at most 2*exp(-2*num_perm*eps^2), so at most delta of the time for
+eps = sqrt(ln(2/delta)/(2*num_perm)):
+        -- num_perm=128: above 0.1200 at most 5% of the time, above 0.1439 at most 1%
+        -- num_perm=512: above 0.0600 at most 5% of the time, above 0.0719 at most 1%
+Users are hashed to 64 bits first, so collisions between distinct users are negligible.
+"""
+import hashlib
+import numpy as np
+
+EMPTY = np.iinfo(np.uint64).max
+
+
+def hash_users(users):
+    """
+    Maps user identifiers to stable 64-bit integers, independent of PYTHONHASHSEED
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(str(u).encode(), digest_size=8).digest(), 'little') for u in users),
+                       dtype=np.uint64, count=len(users))
+
+
+def get_permutations(num_perm, seed=1):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+
+def _mix(x):
+    # splitmix64 finalizer, uint64 arithmetic wraps modulo 2^64
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def signature(users, perms):
+    """
+    :param users: an iterable of user identifiers
+    :param perms: the seeds from get_permutations
+    :return: a uint64 array of length num_perm, all EMPTY for an empty set
+    """
+    sig = np.full(len(perms), EMPTY, dtype=np.uint64)
+    hashed = hash_users(list(users))
+    for block in np.array_split(hashed, max(1, len(hashed) // 4096)):
+        if len(block):
+            hvals = _mix(block[:, None] ^ perms[None, :])
+            sig = np.minimum(sig, hvals.min(axis=0))
+    return sig
+
+
+def minhash_jaccard_matrix(sets, num_perm=128, seed=1):
+    """
+    Estimates the pairwise jaccard dissimilarities of a list of sets
+    :param sets: a list of sets, one per tower position
+    :param num_perm: the signature size, see the module notes for the error bounds
+    :return: a TxT matrix with a zero diagonal. Pairs where both sets are empty are 1, as in jaccard_fn
+    """
+    perms = get_permutations(num_perm, seed)
+    sigs = np.array([signature(s, perms) for s in sets]).reshape(len(sets), num_perm)
+    return signature_jaccard_matrix(sigs)
+
+
+def signature_jaccard_matrix(sigs):
+    """
+    :param sigs: a (T, num_perm) array of signatures
+    :return: the TxT matrix of estimated jaccard dissimilarities
+    """
+    num_sets, num_perm = sigs.shape
+    agree = np.zeros((num_sets, num_sets))
+    for k in range(num_perm):
+        col = sigs[:, k]
+        agree += (col[:, None] == col[None, :]) & (col[:, None] != EMPTY)
+
+    mat = 1 - agree/num_perm
+    np.fill_diagonal(mat, 0)
+    return mat
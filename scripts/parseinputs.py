@@ -1,6 +1,8 @@
-import csv, os
+import csv, os, locale, shutil, tempfile, time
+import multiprocessing as mp
 from collections import defaultdict, namedtuple
-from helper_funcs import parse_time
+from helper_funcs import parse_time, get_csv_files
+from user_store import UserStoreWriter, convert_users_dir
 
 #################
 ## Variable Names:
@@ -103,15 +105,65 @@ def get_tac_codes(tacf):
 
 
 
+def parse_record(row, idxs, characteristic_towers, country_ptrs, tac_costs):
+    """
+    Parses a single CDR row into its sending tower and output record
+    :param row: a row of the records file split on ';'
+    :param idxs: a DataIndices object for the records header
+    :return: a (sending_tower, record) pair, or None when the row is dropped. The record is:
+        [user, day, hour, minute, second, receiving_tower, nation of origin, phone_cost]
+    """
+    user, time, send_t = row[idxs.user], row[idxs.time], row[idxs.s_tower]
+    rec_t, nat_t, tac_code = row[idxs.r_tower], row[idxs.nationality], row[idxs.tac_code]
+
+    send = characteristic_towers.get(send_t, None)
+    if send is None:
+        return None
+
+    tparsed = parse_time(time)
+    if tparsed is None:
+        return None
+
+    urec = [user] + tparsed
+    nat = ''
+    if nat_t != '':
+        nat = int(nat_t)
+    other_features = [characteristic_towers.get(rec_t, None), country_ptrs.get(nat, None), tac_costs.get(tac_code, None)]
+    urec.extend([i if i is not None else -1 for i in other_features])
+    return send, urec
+
+
+def flush_users(users, users_dir, store=None):
+    """
+    Appends the buffered records of each tower to users_dir/<tower>.csv and empties the buffer
+    :param users: a dictionary of tower -> list of records
+    :param users_dir: the directory of per-tower user files
+    :param store: an optional UserStoreWriter that the records are also appended to
+    """
+    if store is not None:
+        store.append(users)
+    for k, v in users.items():
+        ofile = users_dir + str(k) + ".csv"
+        with open(ofile, "a", newline='') as f:
+            writer = csv.writer(f, delimiter=",")
+            writer.writerows(v)
+    users.clear()
+
+
 ##################
 # Main Function
-def parse_data_input(ifiles, odir):
+def parse_data_input(ifiles, odir, buffer_rows=None, columnar=False):
     """
     Handles the parsing of the input data file
     :param ifiles: the data file to be parsed
     :param tower_pointers: a dictionary of pointers to characteristic towers
     :param odir: the directory to be written to. Assumes no directory exists and creates the directory
                 with an additional '/users/' subdirectory
+    :param buffer_rows: when set, streams the records and flushes the per-tower buffers to disk
+                as soon as buffer_rows records are held in memory. Peak memory then
+                depends on buffer_rows and not on the size of the records file. The per-tower
+                files are identical to those written with buffer_rows=None.
+    :param columnar: when True, also writes the columnar store of user_store to odir/users_bin/
     :returns: processes the input data and groups by tower returning a list of:
         [user, day, hour, minute, second, receiving_tower, nation of origin, phone_cost]
     """
@@ -129,35 +181,29 @@ def parse_data_input(ifiles, odir):
     headers = next(reader, None)
     idxs = get_indices(headers)
 
-    users = defaultdict(list)
+    store = UserStoreWriter(odir + '/users_bin/') if columnar else None
+    users, buffered = defaultdict(list), 0
     print("About to begin processing data")
 
     for row in reader:
-        user, time, send_t = row[idxs.user], row[idxs.time], row[idxs.s_tower]
-        rec_t, nat_t, tac_code = row[idxs.r_tower], row[idxs.nationality], row[idxs.tac_code]
-
-        send = characteristic_towers.get(send_t, None)
-        if send is None:
+        parsed = parse_record(row, idxs, characteristic_towers, country_ptrs, tac_costs)
+        if parsed is None:
             continue
+        send, urec = parsed
+        users[send].append(urec)
+        buffered += 1
+        if buffer_rows is not None and buffered >= buffer_rows:
+            flush_users(users, users_dir, store)
+            buffered = 0
 
-        tparsed = parse_time(time)
-        if tparsed is None:
-            continue
-        else:
-            urec = [user] + tparsed
-            nat = ''
-            if nat_t is not '':
-                nat = int(nat_t)
-            other_features = [characteristic_towers.get(rec_t, None), country_ptrs.get(nat, None), tac_costs.get(tac_code, None)]
-            urec.extend([i if i is not None else -1 for i in other_features])
-            users[send].append(urec)
-
-    for k,v in users.items():
-        ofile = users_dir + str(k) + ".csv"
-        writer = csv.writer(open(ofile, "w"), delimiter=",")
-        for row in v:
-            writer.writerow(row)
+    flush_users(users, users_dir, store)
+    if store is not None:
+        store.close()
+
+    write_references(odir, characteristic_towers, country_ptrs)
 
+
+def write_references(odir, characteristic_towers, country_ptrs):
     tower_ofile = odir + 'characteristic_towers.csv'
     writer = csv.writer(open(tower_ofile, 'w'), delimiter=',')
     for k,v in characteristic_towers.items():
@@ -168,6 +214,165 @@ def parse_data_input(ifiles, odir):
     for k,v in country_ptrs.items():
         writer.writerow([k,v])
 
+
+##################
+# Parallel Parsing
+_lookups = None
+
+
+def _init_worker(lookups):
+    global _lookups
+    _lookups = lookups
+
+
+def get_chunk_offsets(recordsf, n_chunks):
+    """
+    Splits the records file into byte ranges that start and end on line boundaries
+    :param recordsf: the records file, whose first line is the header
+    :param n_chunks: the number of ranges to aim for
+    :return: a list of (start, end) byte offsets covering every record after the header
+    """
+    size = os.path.getsize(recordsf)
+    with open(recordsf, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        step = max(1, (size - start) // n_chunks)
+
+        bounds = [start]
+        for i in range(1, n_chunks):
+            f.seek(max(start + i*step, bounds[-1]))
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+        bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_lines(recordsf, start, end, encoding):
+    with open(recordsf, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode(encoding)
+
+
+def _parse_chunk(recordsf, start, end, idxs, shard_dir, buffer_rows):
+    characteristic_towers, country_ptrs, tac_costs, encoding = _lookups
+    os.makedirs(shard_dir)
+
+    users, buffered = defaultdict(list), 0
+    for row in csv.reader(_read_lines(recordsf, start, end, encoding), delimiter=';'):
+        parsed = parse_record(row, idxs, characteristic_towers, country_ptrs, tac_costs)
+        if parsed is None:
+            continue
+        send, urec = parsed
+        users[send].append(urec)
+        buffered += 1
+        if buffer_rows is not None and buffered >= buffer_rows:
+            flush_users(users, shard_dir)
+            buffered = 0
+
+    flush_users(users, shard_dir)
+    return shard_dir
+
+
+def merge_shards(shard_dirs, users_dir):
+    """
+    Concatenates per-chunk tower files, in chunk order, into users_dir/<tower>.csv
+    :param shard_dirs: the shard directories ordered by their position in the records file
+    :param users_dir: the directory of per-tower user files
+    """
+    towers = set()
+    for shard_dir in shard_dirs:
+        towers.update(get_csv_files(shard_dir))
+
+    for tfile in towers:
+        with open(users_dir + tfile, 'wb') as out:
+            for shard_dir in shard_dirs:
+                spath = shard_dir + tfile
+                if os.path.exists(spath):
+                    with open(spath, 'rb') as shard:
+                        shutil.copyfileobj(shard, out)
+
+
+def parse_data_input_parallel(ifiles, odir, processes=None, buffer_rows=None, chunks_per_process=4, columnar=False):
+    """
+    Parses the records file on a pool of processes. The file is split into byte ranges aligned on
+    newlines, each range is parsed into per-tower shards and the shards are merged in file order,
+    so the users directory is identical to the one written by parse_data_input.
+    Assumes no record contains an embedded newline.
+    :param ifiles: an InFiles object
+    :param odir: the directory to be written to, as in parse_data_input
+    :param processes: number of worker processes, defaults to the number of cores
+    :param buffer_rows: per-worker record buffer, as in parse_data_input
+    :param chunks_per_process: number of byte ranges handed to each worker
+    :param columnar: when True, also writes the columnar store to odir/users_bin/ from the merged files
+    """
+    users_dir = odir + '/users/'
+    if os.path.exists(odir):
+        raise ValueError("Out directory exists")
+    else:
+        os.makedirs(users_dir)
+
+    processes = processes or mp.cpu_count()
+    characteristic_towers = get_towers(ifiles.towers)
+    country_ptrs = get_countrycodes(ifiles.country_codes)
+    tac_costs = get_tac_codes(ifiles.tac_codes)
+    encoding = locale.getpreferredencoding(False)
+
+    with open(ifiles.records, encoding=encoding) as f:
+        idxs = get_indices(next(csv.reader(f, delimiter=';')))
+
+    offsets = get_chunk_offsets(ifiles.records, processes*chunks_per_process)
+    shards_dir = odir + '/shards/'
+    shard_dirs = [shards_dir + str(i) + '/' for i in range(len(offsets))]
+    print("About to begin processing data in", len(offsets), "chunks")
+
+    lookups = (characteristic_towers, country_ptrs, tac_costs, encoding)
+    with mp.Pool(processes=processes, initializer=_init_worker, initargs=(lookups,)) as p:
+        results = [p.apply_async(_parse_chunk, args=(ifiles.records, start, end, idxs, sdir, buffer_rows))
+                   for (start, end), sdir in zip(offsets, shard_dirs)]
+        [r.get() for r in results]
+
+    merge_shards(shard_dirs, users_dir)
+    shutil.rmtree(shards_dir)
+    if columnar:
+        convert_users_dir(users_dir, odir + '/users_bin/')
+
+    write_references(odir, characteristic_towers, country_ptrs)
+
+
+def benchmark_parse(ifiles, process_counts=(1, 2, 4, 8)):
+    """
+    Times parse_data_input against parse_data_input_parallel on the given input files
+    :return: a list of (processes, seconds, speedup) with processes=0 being the serial parser
+    """
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp:
+        istart = time.time()
+        parse_data_input(ifiles, tmp + '/serial/')
+        serial = time.time() - istart
+        results.append((0, serial, 1.0))
+
+        for n in process_counts:
+            istart = time.time()
+            parse_data_input_parallel(ifiles, tmp + '/parallel_' + str(n) + '/', processes=n)
+            elapsed = time.time() - istart
+            results.append((n, elapsed, serial/elapsed))
+
+    for n, elapsed, speedup in results:
+        print("Processes: ", n, " time: ", elapsed, " speedup: ", speedup)
+    return results
+
+
 if __name__ == "__main__":
     recordsf = './DWFET_CDR_CELLID_201406.csv'
     towersf = './towers.csv'
@@ -179,4 +384,6 @@ if __name__ == "__main__":
                      towers=towersf,
                      tac_codes=tac_db,
                      country_codes=countriesf)
-    parse_data_input(ifiles, out_directory)
+    parse_data_input(ifiles, out_directory, buffer_rows=1000000, columnar=True)
+    # parse_data_input_parallel(ifiles, out_directory, buffer_rows=250000)
+    # benchmark_parse(ifiles)
@@ -0,0 +1,64 @@
+"""
+Numpy arrays in shared memory for pool workers. The parent calls share_array and passes the SharedArray
+spec to the workers, which attach with attach_array. The parent frees the block with release.
+"""
+import numpy as np
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+SharedArray = namedtuple('SharedArray', 'name shape dtype')
+
+_attached = dict()
+_own_tracker = None
+
+
+def _attach_tracked(name):
+    # Before Python 3.13 attaching registers the block with the resource tracker. A tracker inherited
+    # from the parent already holds the parent's registration, which unregistering would remove. A
+    # tracker started by this process would unlink the block when the process exits, so the block is
+    # unregistered from it.
+    # The tracker has no public way to tell the two apart, so this reads its private _fd, which stays None
+    # until the process starts a tracker and is set in workers both by fork and by spawn_main. This
+    # fallback only runs on Python 3.8 to 3.12, the versions with a resource tracker but no track
+    # argument; it was checked on 3.11, and getattr keeps an unexpected tracker from raising.
+    global _own_tracker
+    if _own_tracker is None:
+        _own_tracker = getattr(resource_tracker._resource_tracker, '_fd', None) is None
+    shm = shared_memory.SharedMemory(name=name)
+    if _own_tracker:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def share_array(arr):
+    """
+    Copies an array into a new shared memory block
+    :return: the SharedMemory object, to be closed and unlinked by the caller, and its SharedArray spec
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    view[...] = arr
+    return shm, SharedArray(name=shm.name, shape=arr.shape, dtype=arr.dtype.str)
+
+
+def attach_array(spec):
+    """
+    Returns a read-only view of a shared array. Each process attaches to a block once and keeps
+    the mapping for the rest of its life.
+    """
+    shm = _attached.get(spec.name, None)
+    if shm is None:
+        try:
+            shm = shared_memory.SharedMemory(name=spec.name, track=False)
+        except TypeError:
+            shm = _attach_tracked(spec.name)
+        _attached[spec.name] = shm
+    arr = np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+    arr.setflags(write=False)
+    return arr
+
+
+def release(shm):
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,66 @@
+"""
+CumulativeSnapshots holds a model accumulated day by day as per-day deltas and builds the normalized
+view as of a day when it is first asked for. Walking the days in increasing order adds one delta per
+day, and the most recently used views are cached.
+"""
+from collections import OrderedDict
+
+
+class CumulativeSnapshots:
+
+    def __init__(self, deltas, normalize, cache_size=4):
+        """
+        :param deltas: a day -> array or sparse matrix dictionary of what was added on each day
+        :param normalize: maps a running total to the view returned for a day, must not modify its input
+        :param cache_size: the number of views kept in the cache
+        """
+        self.days = sorted(deltas.keys())
+        self.deltas = dict(deltas)
+        self.normalize = normalize
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._total_day, self._total = None, None
+
+    def _running_total(self, day):
+        if self._total_day is not None and self._total_day > day:
+            self._total_day, self._total = None, None
+        for d in self.days:
+            if d > day:
+                break
+            if self._total_day is not None and d <= self._total_day:
+                continue
+            self._total = self.deltas[d] if self._total is None else self._total + self.deltas[d]
+            self._total_day = d
+        return self._total
+
+    def __getitem__(self, day):
+        if day not in self.deltas:
+            raise KeyError(day)
+        view = self._cache.get(day, None)
+        if view is None:
+            view = self.normalize(self._running_total(day))
+            self._cache[day] = view
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(day)
+        return view
+
+    def get(self, day, default=None):
+        return self[day] if day in self.deltas else default
+
+    def __contains__(self, day):
+        return day in self.deltas
+
+    def __iter__(self):
+        return iter(self.days)
+
+    def __len__(self):
+        return len(self.days)
+
+    def keys(self):
+        return list(self.days)
+
+    def items(self):
+        for day in self.days:
+            yield day, self[day]
@@ -0,0 +1,90 @@
+"""
+Columnar binary store of the per-tower user records written by parseinputs:
+        -- <tower>.bin: the tower's records as a flat RECORD_DTYPE array, in the row order of users/<tower>.csv
+        -- user_ids.csv: the interned user table, user id i is on row i
+The .bin files have no header, so they can be appended to in batches and read with np.memmap.
+"""
+import csv, os
+import numpy as np
+
+from helper_funcs import get_csv_files
+
+RECORD_DTYPE = np.dtype([('user', '<i4'), ('day', '<i4'), ('hour', '<i4'), ('minute', '<i4'),
+                         ('second', '<i4'), ('r_tower', '<i4'), ('nationality', '<i4'), ('cost', '<i4')])
+USER_IDS = 'user_ids.csv'
+
+
+class UserStoreWriter:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.user_ids = dict()
+        os.makedirs(store_dir)
+
+    def _intern(self, user):
+        uid = self.user_ids.get(user, None)
+        if uid is None:
+            uid = len(self.user_ids)
+            self.user_ids[user] = uid
+        return uid
+
+    def append(self, users):
+        """
+        Appends buffered records to the store
+        :param users: a dictionary of tower -> list of records of the form
+            [user, day, hour, minute, second, receiving_tower, nation of origin, phone_cost]
+        """
+        for tower, rows in users.items():
+            arr = np.array([(self._intern(r[0]),) + tuple(int(v) for v in r[1:]) for r in rows],
+                           dtype=RECORD_DTYPE)
+            with open(self.store_dir + str(tower) + '.bin', 'ab') as f:
+                arr.tofile(f)
+
+    def close(self):
+        users = sorted(self.user_ids.items(), key=lambda x: x[1])
+        with open(self.store_dir + USER_IDS, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=',')
+            for user, _ in users:
+                writer.writerow([user])
+
+
+def convert_users_dir(users_dir, store_dir, batch_rows=1000000):
+    """
+    Writes the columnar store for an existing directory of per-tower user CSVs
+    :param users_dir: the users directory written by parse_data_input
+    :param store_dir: the store directory to create
+    """
+    writer = UserStoreWriter(store_dir)
+    for ifile in get_csv_files(users_dir):
+        tower = int(ifile.replace('.csv', ''))
+        batch = list()
+        for row in csv.reader(open(users_dir + ifile), delimiter=','):
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                writer.append({tower: batch})
+                batch = list()
+        writer.append({tower: batch})
+    writer.close()
+
+
+def get_store_towers(store_dir):
+    return [int(f.replace('.bin', '')) for f in get_csv_files(store_dir, suffix='.bin')]
+
+
+def load_tower(store_dir, tower):
+    """
+    Memory-maps the records of a tower
+    :return: a read-only structured array of RECORD_DTYPE, columns are accessed as arr['day'] etc.
+    """
+    fpath = store_dir + str(tower) + '.bin'
+    if os.path.getsize(fpath) == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(fpath, dtype=RECORD_DTYPE, mode='r')
+
+
+def load_user_ids(store_dir):
+    """
+    :return: a numpy array of user identifiers indexed by interned user id
+    """
+    reader = csv.reader(open(store_dir + USER_IDS), delimiter=',')
+    return np.array([row[0] for row in reader], dtype=object)